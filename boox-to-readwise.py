@@ -1,6 +1,5 @@
 #!/usr/bin/env python3
 
-import fileinput
 import json
 import utils
 
@@ -114,7 +113,7 @@ def collect_highlights(lines):
 def main(args):
     dry_run = args[1] == "-n" if len(sys.argv) > 1 else False
     input_args = args[1:] if not dry_run else args[2:]
-    highlights = collect_highlights(fileinput.input(input_args))
+    highlights = collect_highlights(utils.read_lines(input_args))
 
     if dry_run:
         print(json.dumps(highlights, indent=2, ensure_ascii=False))
@@ -1,8 +1,8 @@
 #!/usr/bin/env python3
 
 import csv
-import fileinput
 import json
+from datetime import datetime
 import utils
 
 NAME_MAPPING = {
@@ -15,35 +15,74 @@ NAME_MAPPING = {
     "Date": "highlighted_at",
 }
 
+DATE_FORMATS = ["%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%m/%d/%Y %H:%M", "%m/%d/%Y"]
+
+
+def parse_location(value):
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+def parse_highlighted_at(value):
+    try:
+        return datetime.fromisoformat(value).isoformat()
+    except ValueError:
+        pass
+    for format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, format).isoformat()
+        except ValueError:
+            continue
+    return value
+
+
+COERCIONS = {
+    "location": parse_location,
+    "highlighted_at": parse_highlighted_at,
+}
+
+
+def compile_columns(fieldnames):
+    columns = []
+    for index, field in enumerate(fieldnames):
+        name = NAME_MAPPING.get(field, field)
+        columns.append((index, name, COERCIONS.get(name)))
+    return columns
+
 
 def collect_highlights(lines):
-    # Create a CSV reader object
-    reader = csv.DictReader(lines)
-    fieldnames = reader.fieldnames
+    reader = csv.reader(lines)
+    fieldnames = next(reader, None)
+    if fieldnames is None:
+        return
+    columns = compile_columns(fieldnames)
 
-    result = []
     for row in reader:
+        # Blank lines and rows of empty cells, e.g. trailing `,,,` lines
+        if not any(row):
+            continue
         article = {}
-        for field in fieldnames:
-            if row[field] != "":
-                article[NAME_MAPPING.get(field, field)] = row[field]
+        for index, name, coerce in columns:
+            if index < len(row) and row[index] != "":
+                value = row[index]
+                article[name] = coerce(value) if coerce is not None else value
         if "location" in article and "location_type" not in article:
             article["location_type"] = "page"
-        result.append(article)
-
-    return result
+        yield article
 
 
 def main(args):
     dry_run = args[1] == "-n" if len(sys.argv) > 1 else False
     input_args = args[1:] if not dry_run else args[2:]
-    highlights = collect_highlights(fileinput.input(input_args))
+    highlights = collect_highlights(utils.read_lines(input_args))
 
     if dry_run:
-        print(json.dumps(highlights, indent=2, ensure_ascii=False))
+        print(json.dumps(list(highlights), indent=2, ensure_ascii=False))
         return
 
-    utils.create_highlights(highlights)
+    utils.create_highlights_in_batches(highlights)
 
 
 if __name__ == "__main__":
@@ -1,54 +1,146 @@
 #!/usr/bin/env python3
 
 import utils
-import fileinput
 import json
+import re
+from collections import deque
+from html.parser import HTMLParser
 
-def collect_highlights():
-    print(soup)
-    return []
-    article = {
-        "title": None,
-        "author": None,
-        "source_type": "Duku",
-        "category": "books",
-    }
-    result = []
-    for line in lines:
-        line = line.strip()
-        if line == "":
-            continue
-
-        if line.startswith("## 《") and line.endswith("》"):
-            article["title"] = "读库 - " + line[4:-1]
-        elif line.startswith("## "):
-            article["title"] = "读库 - " + line[3:]
-        elif line.startswith("**"):
-            article["author"] = line.split("**")[1].strip()
-        elif line.startswith("> "):
-            pending_article = article.copy()
-            pending_article["text"] = line[2:]
-            result.append(pending_article)
-        elif line.startswith("# ") or line.startswith("* "):
-            pass
+# Headings inside an article become heading highlights
+HEADING_NOTES = {"h3": ".h1", "h4": ".h2"}
+# Line breaks between CJK characters are not spaces
+CJK_BREAK = re.compile(
+    r"(?<=[\u3000-\u9fff\uff00-\uffef])\s+(?=[\u3000-\u9fff\uff00-\uffef])"
+)
+
+
+def clean_text(parts):
+    return " ".join(CJK_BREAK.sub("", "".join(parts)).split())
+
+
+class DukuParser(HTMLParser):
+    """Walk a Duku export once as it is fed. Each `h2` starts an article,
+    which is a book of its own, the first paragraph opening in bold before
+    any passage or heading gives its author, `h3`/`h4` are headings and each
+    paragraph of a blockquote is a passage. Passages before the first `h2`,
+    such as an epigraph, go to the `h1` volume, or are skipped without one. Finished highlights queue up
+    in `highlights`."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.article = {
+            "title": None,
+            "author": None,
+            "source_type": "Duku",
+            "category": "books",
+        }
+        self.highlights = deque()
+        self.capture = None
+        self.parts = []
+        self.quote_depth = 0
+        self.paragraph_empty = False
+        self.author_pending = False
+
+    def start_capture(self, kind):
+        self.capture = kind
+        self.parts = []
+
+    def emit(self, text, note=None):
+        if text == "" or self.article["title"] is None:
+            return
+        self.author_pending = False
+        highlight = self.article.copy()
+        highlight["text"] = text
+        if note is not None:
+            highlight["note"] = note
+        self.highlights.append(highlight)
+
+    def flush_passage(self):
+        self.emit(clean_text(self.parts))
+        self.parts = []
+
+    def handle_starttag(self, tag, attrs):
+        if self.quote_depth > 0:
+            if tag == "blockquote":
+                self.quote_depth += 1
+            elif tag in ("p", "br"):
+                self.flush_passage()
+        elif tag == "blockquote":
+            self.quote_depth = 1
+            self.start_capture("quote")
+        elif tag in ("h1", "h2") or tag in HEADING_NOTES:
+            self.start_capture(tag)
+        elif tag == "p":
+            self.paragraph_empty = True
+        elif (
+            tag in ("strong", "b")
+            and self.paragraph_empty
+            and self.author_pending
+            and self.capture is None
+        ):
+            self.start_capture("author")
+
+    def handle_endtag(self, tag):
+        if self.quote_depth > 0:
+            if tag == "p":
+                self.flush_passage()
+            elif tag == "blockquote":
+                self.quote_depth -= 1
+                if self.quote_depth == 0:
+                    self.flush_passage()
+                    self.capture = None
+        elif tag == self.capture:
+            self.finish_heading(tag)
+        elif tag in ("strong", "b") and self.capture == "author":
+            self.article["author"] = clean_text(self.parts) or None
+            self.author_pending = False
+            self.capture = None
+        elif tag == "p":
+            self.paragraph_empty = False
+
+    def handle_data(self, data):
+        if self.capture is not None:
+            self.parts.append(data)
+        if data.strip():
+            self.paragraph_empty = False
+
+    def finish_heading(self, tag):
+        text = clean_text(self.parts)
+        self.capture = None
+        if tag == "h1":
+            self.article["title"] = text or None
+            self.article["author"] = None
+            self.author_pending = False
+        elif tag == "h2":
+            if text.startswith("《") and text.endswith("》"):
+                text = text[1:-1]
+            self.article["title"] = "读库 - " + text
+            self.article["author"] = None
+            self.author_pending = True
         else:
-            raise RuntimeError("unexpected line: " + line)
+            self.emit(text, HEADING_NOTES[tag])
+
 
-    return result
+def collect_highlights(lines):
+    parser = DukuParser()
+    for line in lines:
+        parser.feed(line)
+        while parser.highlights:
+            yield parser.highlights.popleft()
+    parser.close()
+    yield from parser.highlights
 
 
 def main(args):
-    dry_run = args[1] == "-n" if len(sys.argv) > 1 else False
+    dry_run = args[1] == "-n" if len(args) > 1 else False
     input_args = args[1:] if not dry_run else args[2:]
-    soup = BeautifulSoup(''.join(line in fileinput.input(input_args))), 'html.parser')
-    print(soup)
-    highlights = collect_highlights(soup)
+    highlights = collect_highlights(utils.read_lines(input_args))
 
     if dry_run:
-        print(json.dumps(highlights, indent=2, ensure_ascii=False))
+        print(json.dumps(list(highlights), indent=2, ensure_ascii=False))
         return
 
-    utils.create_highlights(highlights)
+    utils.create_highlights_in_batches(highlights)
 
 
 if __name__ == "__main__":
@@ -2,10 +2,25 @@
 
 import argparse
 import hashlib
+import itertools
 import json
 import os
 import re
-from collections import OrderedDict
+import sqlite3
+import tempfile
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import utils
+
+MANIFEST_NAME = ".readwise-manifest.json"
+REGISTRY_NAME = ".readwise-block-ids.json"
+EXPORT_STATE_NAME = ".readwise-export.json"
+EXPORT_IDS_BATCH_SIZE = 100
+BLOCK_ID_RE = re.compile(r"\^([0-9a-f]{8,40})$")
+ANCHOR_RE = re.compile(r"(?:^|\s)(\^[A-Za-z0-9-]+)[ \t]*$", re.MULTILINE)
+HEADING_RE = re.compile(r"#{1,6} ")
 
 
 def sanitize_author(author):
@@ -67,9 +82,60 @@ def process_note(note_text):
     return remaining_tags, heading_level, concat_index, note_content
 
 
-def build_highlight_id(text, location, title):
+def build_highlight_id(text, location, title, registry=None):
     raw = f"{text}|{location}|{title}"
-    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:8]
+    digest = hashlib.sha1(raw.encode("utf-8")).hexdigest()
+    if registry is None:
+        return digest[:8]
+    return registry.claim(digest)
+
+
+class BlockIdRegistry:
+    """Block IDs handed out across the vault, each mapped to the full SHA-1
+    it was cut from. A highlight whose 8 character prefix is owned by another
+    digest gets the shortest longer prefix that is free, so IDs only grow
+    on a collision and never change once given out.
+
+    IDs read back from notes the registry has not seen yet have no known
+    owner and go to the first highlight that hashes to them."""
+
+    def __init__(self, path):
+        self.path = path
+        data = utils.load_json(path, {})
+        self.ids = data.get("ids", {})
+        self.notes = data.get("notes", {})
+
+    def claim(self, digest):
+        for length in range(8, len(digest) + 1):
+            block_id = digest[:length]
+            owner = self.ids.setdefault(block_id, digest)
+            if owner == digest:
+                return block_id
+            if not owner:
+                self.ids[block_id] = digest
+                return block_id
+        raise ValueError(f"no free block ID for {digest}")
+
+    def refresh(self, output_dir):
+        """Pick up IDs from notes written or edited since the last save."""
+        with os.scandir(output_dir) as it:
+            for dir_entry in it:
+                if not dir_entry.name.endswith(".md") or not dir_entry.is_file():
+                    continue
+                mtime_ns = dir_entry.stat().st_mtime_ns
+                if self.notes.get(dir_entry.name) == mtime_ns:
+                    continue
+                with open(dir_entry.path, encoding="utf-8") as handle:
+                    for anchor in ANCHOR_RE.findall(handle.read()):
+                        match = BLOCK_ID_RE.fullmatch(anchor)
+                        if match:
+                            self.ids.setdefault(match.group(1), "")
+                self.notes[dir_entry.name] = mtime_ns
+
+    def save(self):
+        utils.save_json_atomic(
+            self.path, {"ids": self.ids, "notes": self.notes}, sort_keys=True
+        )
 
 
 def normalize_text(text):
@@ -156,6 +222,37 @@ def format_location(highlight):
     return str(location)
 
 
+def highlight_anchor(highlight, registry=None):
+    """The block ID format_highlight_markdown gives a highlight, without
+    rendering it. Headings and note-only entries have none."""
+    if "anchor" in highlight:
+        return highlight["anchor"]
+    text = highlight.get("text") or ""
+    note_content = highlight.get("note_content")
+    if highlight.get("heading_level"):
+        return None
+    if len(text.strip()) <= 1 and note_content:
+        return None
+    if note_content:
+        note_lines = note_content.splitlines()
+        if note_lines and note_lines[0].strip().startswith("^"):
+            return note_lines[0].strip()
+    location_text = format_location(highlight)
+    block_id = build_highlight_id(
+        text, location_text or "", highlight.get("title", ""), registry
+    )
+    return f"^{block_id}"
+
+
+def assign_anchors(entries, registry):
+    """Resolve anchors against the registry up front, in the process that
+    owns it, so the render workers only reuse them."""
+    merged = merge_consecutive_highlights(entries)
+    for entry in merged:
+        entry["anchor"] = highlight_anchor(entry, registry)
+    return merged
+
+
 def format_highlight_markdown(highlight):
     text = highlight.get("text") or ""
     note_content = highlight.get("note_content")
@@ -192,16 +289,13 @@ def format_highlight_markdown(highlight):
     else:
         location_suffix = ""
 
-    anchor_override = None
     note_body = note_content
     if note_content:
         note_lines = note_content.splitlines()
         if note_lines and note_lines[0].strip().startswith("^"):
-            anchor_override = note_lines[0].strip()
             note_body = "\n".join(note_lines[1:]).strip()
 
-    highlight_id = build_highlight_id(text, location_text or "", highlight.get("title", ""))
-    anchor_text = anchor_override or f"^{highlight_id}"
+    anchor_text = highlight_anchor(highlight)
 
     lines = [f"- {first_part}{location_suffix} {anchor_text}".rstrip()]
 
@@ -245,8 +339,6 @@ def build_metadata_section(entry):
                 f"**Zotero App Link**:: [Open in Zotero]({source_url})"
             )
         else:
-            print(source_url)
-            print(source_url.lower().startswith("weread://"))
             lines.append(f"**URL**:: {source_url}")
     return "\n".join(lines)
 
@@ -261,30 +353,103 @@ def build_filename(entry):
     return sanitize_filename(base) + ".md"
 
 
-def group_highlights(entries):
-    groups = OrderedDict()
-    for entry in entries:
-        key = (entry.get("source_url"), entry.get("title"), entry.get("author"))
-        if key not in groups:
-            groups[key] = []
-        groups[key].append(entry)
-    return groups
+def group_key(entry):
+    return (entry.get("source_url"), entry.get("title"), entry.get("author"))
+
+
+def stage_entries(db, entries):
+    """Spill entries into a SQLite staging table tagged with their group, in
+    order of first appearance. Returns the number of groups and the last
+    group of each filename, as groups sharing a filename overwrite it."""
+    db.execute(
+        "CREATE TABLE entries (seq INTEGER PRIMARY KEY, group_id INTEGER, data TEXT)"
+    )
+    groups = {}
+    last_groups = {}
+
+    def tag(entry):
+        key = group_key(entry)
+        group_id = groups.get(key)
+        if group_id is None:
+            group_id = groups[key] = len(groups)
+            last_groups[build_filename(entry)] = group_id
+        return group_id, json.dumps(entry)
+
+    db.executemany(
+        "INSERT INTO entries (group_id, data) VALUES (?, ?)", map(tag, entries)
+    )
+    db.execute("CREATE INDEX entries_group ON entries (group_id, seq)")
+    db.commit()
+    return len(groups), last_groups
+
+
+def group_highlights(db, count):
+    """Yield the staged groups one at a time."""
+    for group_id in range(count):
+        yield [
+            json.loads(data)
+            for (data,) in db.execute(
+                "SELECT data FROM entries WHERE group_id = ? ORDER BY seq", (group_id,)
+            )
+        ]
+
+
+def read_entries(path):
+    with open(path, "r", encoding="utf-8-sig") as handle:
+        yield from utils.JSONStream(handle).records()
+
+
+def flatten_book(book):
+    """Turn a book of the Readwise export into entries shaped like the rows of
+    the JSON export file."""
+    for highlight in book.get("highlights", []):
+        if highlight.get("is_deleted"):
+            continue
+        yield {
+            "text": highlight.get("text"),
+            "title": book.get("title"),
+            "author": book.get("author"),
+            "source_url": book.get("source_url"),
+            "source_type": book.get("source"),
+            "category": book.get("category"),
+            "location": highlight.get("location"),
+            "location_type": highlight.get("location_type"),
+            "highlight_url": highlight.get("url"),
+            "note": highlight.get("note"),
+        }
+
+
+def fetch_entries(client, updated_after):
+    """Stream entries of books changed since `updated_after`. The export only
+    returns the highlights that changed, so changed books are fetched again
+    in full by ID."""
+    if updated_after is None:
+        for book in utils.fetch_export(client):
+            yield from flatten_book(book)
+        return
+    changed = [book["user_book_id"] for book in utils.fetch_export(client, updated_after)]
+    print(f"{len(changed)} books changed since {updated_after}")
+    for ids in itertools.batched(changed, EXPORT_IDS_BATCH_SIZE):
+        for book in utils.fetch_export(client, ids=ids):
+            yield from flatten_book(book)
+
+
+def load_export_state(output_dir):
+    return utils.load_json(os.path.join(output_dir, EXPORT_STATE_NAME), {})
+
+
+def save_export_state(output_dir, state):
+    utils.save_json_atomic(os.path.join(output_dir, EXPORT_STATE_NAME), state, indent=2)
 
 
 def parse_entries(raw_entries):
-    processed = []
     for entry in raw_entries:
         tags, heading_level, concat_index, note_content = process_note(entry.get("note"))
-        processed.append(
-            {
-                **entry,
-                "tags": tags,
-                "heading_level": heading_level,
-                "concat_index": concat_index,
-                "note_content": note_content,
-            }
-        )
-    return processed
+        entry["tags"] = tags
+        entry["heading_level"] = heading_level
+        entry["concat_index"] = concat_index
+        entry["note_content"] = note_content
+        yield entry
 
 
 def build_markdown_for_group(entries):
@@ -307,34 +472,293 @@ def build_markdown_for_group(entries):
     return "\n".join(lines).rstrip() + "\n"
 
 
+def render_missing_highlights(entries, anchors):
+    """Render only the highlights whose anchors are not in the note yet, as
+    (heading line, heading markdown, blocks) per section. The first section
+    holds what comes before any heading."""
+    section = (None, None, [])
+    sections = [section]
+    for entry in merge_consecutive_highlights(entries):
+        if entry.get("heading_level"):
+            heading_markdown = format_highlight_markdown(entry)
+            if heading_markdown:
+                section = (heading_markdown.splitlines()[0], heading_markdown, [])
+                sections.append(section)
+            continue
+        anchor = highlight_anchor(entry)
+        if anchor is not None and anchor in anchors:
+            continue
+        highlight_markdown = format_highlight_markdown(entry)
+        if highlight_markdown:
+            section[2].append((anchor, highlight_markdown))
+    return [section for section in sections if section[2]]
+
+
+def render_group(entries, anchors=None):
+    if anchors is not None:
+        return build_filename(entries[0]), render_missing_highlights(entries, anchors), None
+    markdown = build_markdown_for_group(entries)
+    if not markdown:
+        return None
+    digest = hashlib.sha256(markdown.encode("utf-8")).hexdigest()
+    return build_filename(entries[0]), markdown, digest
+
+
+def render_task(task):
+    return render_group(*task)
+
+
+def render_groups(groups, index, jobs):
+    # Groups whose note is already in the index are merged instead of rendered
+    tasks = ((entries, index.get(build_filename(entries[0]))) for entries in groups)
+    if jobs <= 1:
+        yield from map(render_task, tasks)
+        return
+    # buffersize keeps the pool from pulling every group into memory
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        yield from executor.map(render_task, tasks, buffersize=jobs * 4)
+
+
+def index_anchors(output_dir):
+    """Map each existing note to the set of ^anchor block IDs it contains."""
+    index = {}
+    with os.scandir(output_dir) as it:
+        for dir_entry in it:
+            if not dir_entry.name.endswith(".md") or not dir_entry.is_file():
+                continue
+            with open(dir_entry.path, encoding="utf-8") as handle:
+                index[dir_entry.name] = set(ANCHOR_RE.findall(handle.read()))
+    return index
+
+
+def load_manifest(output_dir):
+    return utils.load_json(os.path.join(output_dir, MANIFEST_NAME), {})
+
+
+def save_manifest(output_dir, manifest):
+    utils.save_json_atomic(
+        os.path.join(output_dir, MANIFEST_NAME),
+        manifest,
+        indent=2,
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+
+
+def is_unchanged(record, output_path, digest):
+    """The file still holds what the manifest recorded and it is what would be
+    written now. Size and mtime catch files edited since the last run."""
+    if record is None or record["sha256"] != digest:
+        return False
+    try:
+        stat = os.stat(output_path)
+    except FileNotFoundError:
+        return False
+    return stat.st_size == record["size"] and stat.st_mtime_ns == record["mtime_ns"]
+
+
+def write_markdown(output_path, markdown, previous=None):
+    # Appends to the same note wait for the earlier ones, in group order
+    if previous is not None:
+        previous.result()
+    tmp_path = output_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as handle:
+        handle.write(markdown)
+    os.replace(tmp_path, output_path)
+    stat = os.stat(output_path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def find_heading(lines, heading, start):
+    for i in range(start, len(lines)):
+        if lines[i] == heading:
+            return i
+    return None
+
+
+def section_end(lines, start):
+    """Index just past the last non-blank line before the next heading."""
+    end = start + 1
+    while end < len(lines) and not HEADING_RE.match(lines[end]):
+        end += 1
+    while end > start + 1 and not lines[end - 1].strip():
+        end -= 1
+    return end
+
+
+def append_markdown(output_path, sections, previous=None):
+    """Insert new highlights at the end of their section in an existing note.
+    Sections missing from the note are appended with their heading. Returns
+    None when nothing was added by this or an earlier chained append."""
+    result = previous.result() if previous is not None else None
+    with open(output_path, encoding="utf-8") as handle:
+        text = handle.read()
+    lines = text.splitlines()
+
+    highlights_start = find_heading(lines, "## Highlights", 0)
+    cursor = highlights_start if highlights_start is not None else 0
+    inserts = []
+    tail = []
+    for heading, heading_markdown, blocks in sections:
+        # Notes carry no anchor, so only skip them if they are already there
+        new_lines = [
+            line
+            for anchor, block in blocks
+            if anchor is not None or block not in text
+            for line in block.splitlines()
+        ]
+        if not new_lines:
+            continue
+        if heading is None:
+            position = highlights_start
+        else:
+            position = find_heading(lines, heading, cursor)
+            if position is None:
+                position = find_heading(lines, heading, 0)
+        if position is None:
+            if heading_markdown:
+                tail.extend(heading_markdown.splitlines())
+            tail.extend(new_lines)
+            continue
+        cursor = position + 1
+        inserts.append((section_end(lines, position), len(inserts), new_lines))
+
+    if not inserts and not tail:
+        return result
+    for position, _, new_lines in sorted(inserts, reverse=True):
+        lines[position:position] = new_lines
+    if tail:
+        while lines and not lines[-1].strip():
+            lines.pop()
+        lines.extend(tail)
+    return write_markdown(output_path, "\n".join(lines) + "\n")
+
+
 def main():
     parser = argparse.ArgumentParser(description="Convert Readwise JSON to Markdown.")
-    parser.add_argument("input_json", help="Path to Readwise JSON export")
+    parser.add_argument("input_json", nargs="?", help="Path to Readwise JSON export")
+    parser.add_argument(
+        "--fetch",
+        action="store_true",
+        help="Fetch books changed since the last fetch from the Readwise API",
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="With --fetch, ignore the last fetch and export every book",
+    )
     parser.add_argument(
         "-o",
         "--output-dir",
         default=".",
         help="Output directory for Markdown files",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of processes rendering Markdown",
+    )
+    parser.add_argument(
+        "--merge",
+        action="store_true",
+        help="Append new highlights to existing notes instead of regenerating them",
+    )
     args = parser.parse_args()
-
-    with open(args.input_json, "r", encoding="utf-8") as handle:
-        raw_entries = json.load(handle)
-
-    processed_entries = parse_entries(raw_entries)
-    grouped = group_highlights(processed_entries)
+    if args.fetch == (args.input_json is not None):
+        parser.error("give either input_json or --fetch")
 
     output_dir = os.path.abspath(args.output_dir)
     os.makedirs(output_dir, exist_ok=True)
 
-    for _, entries in grouped.items():
-        markdown = build_markdown_for_group(entries)
-        if not markdown:
-            continue
-        filename = build_filename(entries[0])
-        output_path = os.path.join(output_dir, filename)
-        with open(output_path, "w", encoding="utf-8") as handle:
-            handle.write(markdown)
+    if args.fetch:
+        export_state = {} if args.full else load_export_state(output_dir)
+        fetched_at = datetime.now(timezone.utc).isoformat()
+        client = utils.ReadwiseClient()
+        entries = fetch_entries(client, export_state.get("updatedAfter"))
+    else:
+        entries = read_entries(args.input_json)
+
+    manifest = load_manifest(output_dir)
+    index = index_anchors(output_dir) if args.merge else {}
+    registry = BlockIdRegistry(os.path.join(output_dir, REGISTRY_NAME))
+    registry.refresh(output_dir)
+    digests = {}
+    statuses = {}
+    writes = {}
+    appends = set()
+    with (
+        tempfile.TemporaryDirectory() as staging_dir,
+        ThreadPoolExecutor() as writers,
+    ):
+        db = sqlite3.connect(os.path.join(staging_dir, "staging.sqlite"))
+        count, last_groups = stage_entries(db, parse_entries(entries))
+        utils.store_highlights(
+            json.loads(data) for (data,) in db.execute("SELECT data FROM entries")
+        )
+        groups = (
+            assign_anchors(entries, registry)
+            for group_id, entries in enumerate(group_highlights(db, count))
+            # A full render is overwritten by a later group sharing the
+            # filename, while merges into an existing note all apply
+            if last_groups[build_filename(entries[0])] == group_id
+            or build_filename(entries[0]) in index
+        )
+        for rendered in render_groups(groups, index, args.jobs):
+            if rendered is None:
+                continue
+            filename, markdown, digest = rendered
+            output_path = os.path.join(output_dir, filename)
+
+            if digest is None:
+                statuses.setdefault(filename, "unchanged")
+                if markdown:
+                    # The merged note no longer matches a full render
+                    appends.add(filename)
+                    writes[filename] = writers.submit(
+                        append_markdown, output_path, markdown, writes.get(filename)
+                    )
+                continue
+
+            if is_unchanged(manifest.get(filename), output_path, digest):
+                statuses[filename] = "unchanged"
+                continue
+            exists = os.path.exists(output_path)
+            statuses[filename] = "updated" if exists else "created"
+            digests[filename] = digest
+            writes[filename] = writers.submit(
+                write_markdown, output_path, markdown, writes.get(filename)
+            )
+
+        db.close()
+
+        for filename, write in writes.items():
+            result = write.result()
+            if result is not None:
+                registry.notes[filename] = result[1]
+            if filename in appends:
+                manifest.pop(filename, None)
+                if result is not None:
+                    statuses[filename] = "updated"
+                continue
+            size, mtime_ns = result
+            manifest[filename] = {
+                "sha256": digests[filename],
+                "size": size,
+                "mtime_ns": mtime_ns,
+            }
+
+    save_manifest(output_dir, manifest)
+    registry.save()
+    if args.fetch:
+        client.close()
+        save_export_state(output_dir, {"updatedAfter": fetched_at})
+    counts = Counter(statuses.values())
+    print(
+        f"{counts['created']} created, {counts['updated']} updated, "
+        f"{counts['unchanged']} unchanged"
+    )
 
 
 if __name__ == "__main__":
@@ -1,9 +1,21 @@
 #!/usr/bin/env python3
 
 import utils
-import fileinput
-import json
+import sys
 
-highlights = json.loads("".join(fileinput.input(encoding='utf-8')))
 
-utils.create_highlights(highlights)
+def read_highlights(files):
+    for file in files or ["-"]:
+        if file == "-":
+            yield from utils.JSONStream(sys.stdin).records()
+            continue
+        with open(file, encoding="utf-8-sig") as handle:
+            yield from utils.JSONStream(handle).records()
+
+
+def main(args):
+    utils.create_highlights_in_batches(read_highlights(args[1:]))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
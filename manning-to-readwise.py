@@ -12,31 +12,16 @@ def parse_authors(authors_html):
     return text.strip()
 
 
-def deduplicate_highlights(highlights):
-    seen = set()
-    result = []
-    for h in highlights:
-        key = h["text"].strip()
-        if key not in seen:
-            seen.add(key)
-            result.append(h)
-    return result
-
-
-def process_manning(input_data):
-    product = input_data["product"]
-    book_title = product["title"]
-    book_author = parse_authors(product["authors"])
-    book_url = product["link"]
-
-    chapters = {}
-    for item in input_data["scrapbookItems"]:
-        chapter_title = item["title"]
-        if chapter_title not in chapters:
-            chapters[chapter_title] = []
-        chapters[chapter_title].append(item)
-
-    result = []
+def process_manning(items, base):
+    """Merge the scrapbook items chapter by chapter in a single pass.
+
+    Items of the same chapter are expected to be adjacent, as they are in the
+    Manning export.
+    """
+
+    def make_entry(entry):
+        entry.update(base)
+        return entry
 
     def flush_pending(pending_green, pending_notes_list, pending_url):
         if not pending_green:
@@ -48,93 +33,133 @@ def process_manning(input_data):
         }
         if pending_notes_list:
             merged_entry["note"] = "\n\n".join(dict.fromkeys(pending_notes_list))
-        result.append(merged_entry)
-
-    for chapter_title, items in chapters.items():
-        result.append(
-            {
-                "text": chapter_title,
-                "note": ".h1",
-            }
-        )
-
-        pending_green = []
-        pending_notes_list = []
-        pending_url = ""
-        items_to_merge = 0
-
-        for item in items:
-            notes_text = None
-            if "notes" in item and item["notes"]:
-                notes_text = "\n\n".join(
-                    n["text"] for n in item["notes"] if n.get("text")
+        yield make_entry(merged_entry)
+
+    chapter_title = None
+    pending_green = []
+    pending_notes_list = []
+    pending_url = ""
+    items_to_merge = 0
+
+    for item in items:
+        if item["title"] != chapter_title:
+            yield from flush_pending(pending_green, pending_notes_list, pending_url)
+            chapter_title = item["title"]
+            yield make_entry(
+                {
+                    "text": chapter_title,
+                    "note": ".h1",
+                }
+            )
+
+            pending_green = []
+            pending_notes_list = []
+            pending_url = ""
+            items_to_merge = 0
+
+        notes_text = None
+        if "notes" in item and item["notes"]:
+            notes_text = "\n\n".join(n["text"] for n in item["notes"] if n.get("text"))
+            if notes_text.startswith(".ignore"):
+                yield from flush_pending(pending_green, pending_notes_list, pending_url)
+                pending_green = []
+                pending_notes_list = []
+                items_to_merge = 0
+                continue
+
+        green_count = 0
+        seen = set()
+        item_green_texts = []
+
+        for hl in item.get("highlights", []):
+            if hl["color"] == "green":
+                green_count += 1
+
+            hl_text = hl["text"].strip()
+            if hl_text in seen:
+                continue
+            seen.add(hl_text)
+            if not hl_text:
+                continue
+
+            if hl["color"] == "gray":
+                continue
+
+            if hl["color"] == "green":
+                item_green_texts.append(hl_text)
+            else:
+                yield from flush_pending(
+                    pending_green, pending_notes_list, pending_url
                 )
-                if notes_text.startswith(".ignore"):
-                    flush_pending(pending_green, pending_notes_list, pending_url)
+                pending_green = []
+                pending_notes_list = []
+                items_to_merge = 0
+
+                entry = {
+                    "text": hl_text,
+                    "highlight_url": item.get("link", ""),
+                }
+                if notes_text:
+                    entry["note"] = notes_text
+                yield make_entry(entry)
+
+        if item_green_texts:
+            pending_green.extend(item_green_texts)
+            if notes_text and notes_text.strip():
+                pending_notes_list.append(notes_text)
+            pending_url = item.get("link", "")
+
+            if items_to_merge == 0 and green_count > 0:
+                items_to_merge = green_count
+            if items_to_merge > 0:
+                items_to_merge -= 1
+                if items_to_merge == 0:
+                    yield from flush_pending(
+                        pending_green, pending_notes_list, pending_url
+                    )
                     pending_green = []
                     pending_notes_list = []
-                    items_to_merge = 0
-                    continue
-            unique_hl = deduplicate_highlights(item.get("highlights", []))
 
-            green_count = sum(
-                1 for h in item.get("highlights", []) if h["color"] == "green"
-            )
-            item_green_texts = []
-
-            for hl in unique_hl:
-                hl_text = hl["text"].strip()
-                if not hl_text:
-                    continue
+    yield from flush_pending(pending_green, pending_notes_list, pending_url)
 
-                if hl["color"] == "gray":
-                    continue
 
-                if hl["color"] == "green":
-                    item_green_texts.append(hl_text)
-                else:
-                    flush_pending(pending_green, pending_notes_list, pending_url)
-                    pending_green = []
-                    pending_notes_list = []
-                    items_to_merge = 0
-
-                    entry = {
-                        "text": hl_text,
-                        "highlight_url": item.get("link", ""),
-                    }
-                    if notes_text:
-                        entry["note"] = notes_text
-                    result.append(entry)
-
-            if item_green_texts:
-                pending_green.extend(item_green_texts)
-                if notes_text and notes_text.strip():
-                    pending_notes_list.append(notes_text)
-                pending_url = item.get("link", "")
-
-                if items_to_merge == 0 and green_count > 0:
-                    items_to_merge = green_count
-                if items_to_merge > 0:
-                    items_to_merge -= 1
-                    if items_to_merge == 0:
-                        flush_pending(pending_green, pending_notes_list, pending_url)
-                        pending_green = []
-                        pending_notes_list = []
-
-        flush_pending(pending_green, pending_notes_list, pending_url)
-
-    base = {
-        "title": book_title,
-        "author": book_author,
-        "source_url": book_url,
+def make_base(product):
+    return {
+        "title": product["title"],
+        "author": parse_authors(product["authors"]),
+        "source_url": product["link"],
         "source_type": "Manning",
         "category": "books",
     }
 
-    for item in result:
-        item.update(base)
 
-    return result
+def read_manning(handle):
+    stream = utils.JSONStream(handle)
+    base = None
+    buffered = None
+    for key in stream.members():
+        if key == "product":
+            base = make_base(stream.value())
+        elif key == "scrapbookItems":
+            if base is not None:
+                yield from process_manning(stream.items(), base)
+            else:
+                # product comes after the items, fill in the metadata later
+                buffered = list(process_manning(stream.items(), {}))
+
+    if buffered is not None:
+        if base is None:
+            raise RuntimeError("product not found")
+        for entry in buffered:
+            entry.update(base)
+            yield entry
+
+
+def upload(highlights, dry_run):
+    if dry_run:
+        print(json.dumps(list(highlights), indent=2, ensure_ascii=False))
+        return
+    utils.create_highlights_in_batches(highlights)
 
 
 def main():
@@ -144,19 +169,12 @@ def main():
         dry_run = True
         args = args[1:]
 
-    if args:
-        with open(args[0], encoding="utf-8") as f:
-            data = json.load(f)
-    else:
-        data = json.load(sys.stdin)
-
-    highlights = process_manning(data)
-
-    if dry_run:
-        print(json.dumps(highlights, indent=2, ensure_ascii=False))
-        return
-
-    utils.create_highlights(highlights)
+    for arg in args or ["-"]:
+        if arg == "-":
+            upload(read_manning(sys.stdin), dry_run)
+        else:
+            with open(arg, encoding="utf-8-sig") as f:
+                upload(read_manning(f), dry_run)
 
 
 if __name__ == "__main__":
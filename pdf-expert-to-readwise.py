@@ -1,8 +1,50 @@
 #!/usr/bin/env python3
 
 import utils
-import fileinput
 import json
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+MARKUP_SUBTYPES = ["/Highlight", "/Underline", "/Squiggly", "/StrikeOut"]
+CJK = re.compile(r"[\u3000-\u9fff\uff00-\uffef]")
+IDENTITY = [1.0, 0.0, 0.0, 1.0, 0.0, 0.0]
+ENCODINGS = {"/WinAnsiEncoding": "cp1252", "/MacRomanEncoding": "mac_roman"}
+GLYPH_NAMES = {
+    "space": " ",
+    "hyphen": "-",
+    "period": ".",
+    "comma": ",",
+    "quoteleft": "‘",
+    "quoteright": "’",
+    "quotedblleft": "“",
+    "quotedblright": "”",
+    "endash": "–",
+    "emdash": "—",
+    "ellipsis": "…",
+    "fi": "fi",
+    "fl": "fl",
+    "ff": "ff",
+    "ffi": "ffi",
+    "ffl": "ffl",
+    "colon": ":",
+    "semicolon": ";",
+    "exclam": "!",
+    "question": "?",
+    "parenleft": "(",
+    "parenright": ")",
+    **{
+        name: str(digit)
+        for digit, name in enumerate(
+            "zero one two three four five six seven eight nine".split()
+        )
+    },
+}
+HEX_PAIR = re.compile(rb"<([0-9a-fA-F]+)>\s*<([0-9a-fA-F]*)>")
+HEX_RANGE = re.compile(
+    rb"<([0-9a-fA-F]+)>\s*<([0-9a-fA-F]+)>\s*(?:<([0-9a-fA-F]*)>|\[([^\]]*)\])"
+)
 
 
 def finalize_article(result, article):
@@ -76,10 +118,375 @@ def collect_highlights(lines):
     return result
 
 
+def quad_boxes(annot):
+    quads = annot.get("/QuadPoints")
+    if not quads:
+        return [[float(v) for v in annot["/Rect"]]]
+    boxes = []
+    for i in range(0, len(quads) - 7, 8):
+        xs = [float(v) for v in quads[i : i + 8 : 2]]
+        ys = [float(v) for v in quads[i + 1 : i + 8 : 2]]
+        boxes.append([min(xs), min(ys), max(xs), max(ys)])
+    return boxes
+
+
+def in_boxes(boxes, x, y, slack=0.5):
+    return any(
+        box[0] - slack <= x <= box[2] + slack and box[1] - slack <= y <= box[3] + slack
+        for box in boxes
+    )
+
+
+def multiply(m, n):
+    return [
+        m[0] * n[0] + m[1] * n[2],
+        m[0] * n[1] + m[1] * n[3],
+        m[2] * n[0] + m[3] * n[2],
+        m[2] * n[1] + m[3] * n[3],
+        m[4] * n[0] + m[5] * n[2] + n[4],
+        m[4] * n[1] + m[5] * n[3] + n[5],
+    ]
+
+
+def apply(m, x, y):
+    return x * m[0] + y * m[2] + m[4], x * m[1] + y * m[3] + m[5]
+
+
+def utf16(digits):
+    return bytes.fromhex(digits.decode()).decode("utf-16-be", "replace")
+
+
+def to_unicode(font):
+    """Character codes to text from the font's ToUnicode CMap."""
+    mapping = {}
+    if "/ToUnicode" not in font:
+        return mapping
+    data = font["/ToUnicode"].get_object().get_data()
+    for block in re.findall(rb"beginbfchar(.*?)endbfchar", data, re.S):
+        for code, digits in HEX_PAIR.findall(block):
+            mapping[int(code, 16)] = utf16(digits)
+    for block in re.findall(rb"beginbfrange(.*?)endbfrange", data, re.S):
+        for low, high, digits, array in HEX_RANGE.findall(block):
+            codes = range(int(low, 16), int(high, 16) + 1)
+            if array:
+                for code, text in zip(codes, re.findall(rb"<([0-9a-fA-F]*)>", array)):
+                    mapping[code] = utf16(text)
+                continue
+            start = int(digits, 16)
+            for offset, code in enumerate(codes):
+                mapping[code] = utf16(b"%0*x" % (len(digits), start + offset))
+    return mapping
+
+
+def glyph_text(name):
+    name = name[1:]
+    if len(name) == 1:
+        return name
+    if name.startswith("uni") and len(name) == 7:
+        try:
+            return chr(int(name[3:], 16))
+        except ValueError:
+            pass
+    return GLYPH_NAMES.get(name)
+
+
+def simple_encoding(font):
+    """Character codes to text from a simple font's /Encoding."""
+    encoding = font.get("/Encoding")
+    encoding = encoding.get_object() if encoding is not None else None
+    base = encoding.get("/BaseEncoding") if hasattr(encoding, "get") else encoding
+    codec = ENCODINGS.get(base, "latin-1")
+    mapping = {code: bytes([code]).decode(codec, "replace") for code in range(256)}
+    code = 0
+    for item in encoding.get("/Differences", []) if hasattr(encoding, "get") else []:
+        if isinstance(item, int):
+            code = item
+            continue
+        text = glyph_text(item)
+        if text is not None:
+            mapping[code] = text
+        code += 1
+    return mapping
+
+
+def cid_widths(array):
+    widths = {}
+    i = 0
+    while i + 1 < len(array):
+        first = int(array[i])
+        if isinstance(array[i + 1].get_object(), list):
+            for offset, width in enumerate(array[i + 1].get_object()):
+                widths[first + offset] = float(width)
+            i += 2
+        else:
+            for code in range(first, int(array[i + 1]) + 1):
+                widths[code] = float(array[i + 2])
+            i += 3
+    return widths
+
+
+def load_font(font):
+    """Code length, widths (in thousandths of the font size) and text of the
+    character codes of a font resource."""
+    font = font.get_object()
+    if font.get("/Subtype") == "/Type0":
+        descendant = font["/DescendantFonts"][0].get_object()
+        loaded = {
+            "code_bytes": 2,
+            "widths": cid_widths(descendant.get("/W", [])),
+            "default_width": float(descendant.get("/DW", 1000)),
+            "text": {},
+        }
+    else:
+        first = int(font.get("/FirstChar", 0))
+        descriptor = font.get("/FontDescriptor")
+        descriptor = descriptor.get_object() if descriptor is not None else {}
+        # Standard 14 fonts may come without widths, Courier is the only one
+        # with a fixed width, half an em is close enough for the others.
+        fixed = "Courier" in str(font.get("/BaseFont", ""))
+        loaded = {
+            "code_bytes": 1,
+            "widths": {
+                first + i: float(w) for i, w in enumerate(font.get("/Widths", []))
+            },
+            "default_width": float(
+                descriptor.get("/MissingWidth", 0) or (600 if fixed else 500)
+            ),
+            "text": simple_encoding(font),
+        }
+    loaded["text"].update(to_unicode(font))
+    return loaded
+
+
+def content_glyphs(operations, resources, ctm, pdf, fonts, forms):
+    """Run a content stream, yielding the glyphs it shows in user space and
+    descending into the Form XObjects it paints."""
+    from pypdf.generic import ContentStream
+
+    resources = resources.get_object() if resources is not None else {}
+    font_resources = resources.get("/Font", {})
+    state = {
+        "font": None,
+        "size": 0.0,
+        "Tc": 0.0,
+        "Tw": 0.0,
+        "Tz": 100.0,
+        "TL": 0.0,
+        "Ts": 0.0,
+    }
+    stack = []
+    tm = tlm = IDENTITY
+
+    def show(string):
+        nonlocal tm
+        font = state["font"]
+        if font is None:
+            return
+        size = state["size"]
+        scale = state["Tz"] / 100
+        data = string.original_bytes
+        step = font["code_bytes"]
+        for i in range(0, len(data) - step + 1, step):
+            code = int.from_bytes(data[i : i + step], "big")
+            width = font["widths"].get(code, font["default_width"]) / 1000 * size
+            spacing = state["Tc"] + (state["Tw"] if step == 1 and code == 32 else 0)
+            advance = (width + spacing) * scale
+            m = multiply(tm, ctm)
+            start, _ = apply(m, 0, state["Ts"])
+            end, _ = apply(m, advance, state["Ts"])
+            # The baseline is at the bottom of the glyph, move up to about its middle
+            x, y = apply(m, advance / 2, state["Ts"] + size * 0.3)
+            height = size * (m[2] ** 2 + m[3] ** 2) ** 0.5
+            space = font["widths"].get(32, font["default_width"]) / 1000 * size
+            text = font["text"].get(code, chr(code))
+            yield text, start, end, x, y, height, space * scale * abs(m[0])
+            tm = multiply([1, 0, 0, 1, advance, 0], tm)
+
+    def next_line(tx, ty):
+        nonlocal tm, tlm
+        tlm = multiply([1, 0, 0, 1, tx, ty], tlm)
+        tm = tlm
+
+    for operands, op in operations:
+        if op == b"q":
+            stack.append((ctm, dict(state)))
+        elif op == b"Q" and stack:
+            ctm, state = stack.pop()
+        elif op == b"cm" and len(operands) == 6:
+            ctm = multiply([float(v) for v in operands], ctm)
+        elif op == b"BT":
+            tm = tlm = IDENTITY
+        elif op == b"Tf" and len(operands) == 2:
+            ref = font_resources.get(operands[0])
+            if ref is None:
+                state["font"] = None
+            else:
+                key = id(ref.get_object())
+                if key not in fonts:
+                    fonts[key] = load_font(ref)
+                state["font"] = fonts[key]
+            state["size"] = float(operands[1])
+        elif op in (b"Tc", b"Tw", b"Tz", b"TL", b"Ts") and operands:
+            state[op.decode()] = float(operands[0])
+        elif op == b"Td" and len(operands) == 2:
+            next_line(float(operands[0]), float(operands[1]))
+        elif op == b"TD" and len(operands) == 2:
+            state["TL"] = -float(operands[1])
+            next_line(float(operands[0]), float(operands[1]))
+        elif op == b"Tm" and len(operands) == 6:
+            tm = tlm = [float(v) for v in operands]
+        elif op == b"T*":
+            next_line(0, -state["TL"])
+        elif op == b"Tj" and operands:
+            yield from show(operands[0])
+        elif op == b"'" and operands:
+            next_line(0, -state["TL"])
+            yield from show(operands[0])
+        elif op == b'"' and len(operands) == 3:
+            state["Tw"], state["Tc"] = float(operands[0]), float(operands[1])
+            next_line(0, -state["TL"])
+            yield from show(operands[2])
+        elif op == b"TJ" and operands:
+            for item in operands[0]:
+                if isinstance(item, (str, bytes)):
+                    yield from show(item)
+                else:
+                    shift = -float(item) / 1000 * state["size"] * state["Tz"] / 100
+                    tm = multiply([1, 0, 0, 1, shift, 0], tm)
+        elif op == b"Do" and operands:
+            ref = resources.get("/XObject", {}).get(operands[0])
+            form = ref.get_object() if ref is not None else None
+            if form is None or form.get("/Subtype") != "/Form" or id(form) in forms:
+                continue
+            matrix = [float(v) for v in form.get("/Matrix", IDENTITY)]
+            yield from content_glyphs(
+                ContentStream(form, pdf).operations,
+                form.get("/Resources", resources),
+                multiply(matrix, ctm),
+                pdf,
+                fonts,
+                forms | {id(form)},
+            )
+
+
+def glyphs(page):
+    """Yield (text, start x, end x, centre x, centre y, font height, space
+    width) for each glyph shown on the page, in user space."""
+    contents = page.get_contents()
+    if contents is None:
+        return
+    yield from content_glyphs(
+        contents.operations, page.get("/Resources"), IDENTITY, page.pdf, {}, set()
+    )
+
+
+def extract_page_text(page, annots):
+    """Text of each annotation, from the glyphs whose centre lies in one of
+    its QuadPoints boxes."""
+    fragments = [[] for _ in annots]
+    last = [None for _ in annots]
+    for text, start, end, x, y, height, space in glyphs(page):
+        for index, (boxes, _) in enumerate(annots):
+            if not in_boxes(boxes, x, y):
+                continue
+            parts = fragments[index]
+            if last[index] is not None and parts:
+                last_end, last_y = last[index]
+                new_line = abs(y - last_y) > height / 2
+                gap = start - last_end > space * 0.3
+                joins_cjk = CJK.match(parts[-1][-1:]) and CJK.match(text[:1])
+                if (new_line and not joins_cjk) or (gap and not new_line):
+                    parts.append(" ")
+            parts.append(text)
+            last[index] = (end, y)
+    return [" ".join("".join(parts).split()) for parts in fragments]
+
+
+def collect_pdf_highlights(path):
+    from pypdf import PdfReader
+
+    reader = PdfReader(path)
+    stem = os.path.splitext(os.path.basename(path))[0]
+    if " - " in stem:
+        author, title = stem.split(" - ", maxsplit=1)
+    else:
+        info = reader.metadata or {}
+        author, title = info.get("/Author"), info.get("/Title") or stem
+
+    article = {
+        "title": title,
+        "author": author,
+        "source_url": None,
+        "source_type": "Weread",
+        "category": "books",
+    }
+    result = []
+    # Pages are loaded lazily, only pages carrying markup annotations have their
+    # content stream parsed.
+    for index, page in enumerate(reader.pages):
+        if "/Annots" not in page:
+            continue
+        annots = []
+        for ref in page["/Annots"]:
+            annot = ref.get_object()
+            if annot.get("/Subtype") in MARKUP_SUBTYPES:
+                annots.append((quad_boxes(annot), annot.get("/Contents")))
+        if len(annots) == 0:
+            continue
+        annots.sort(key=lambda a: (-a[0][0][3], a[0][0][0]))
+
+        for text, (_, note) in zip(extract_page_text(page, annots), annots):
+            if text == "":
+                print(
+                    f"{path}: no text under an annotation on page {index + 1}, skipped",
+                    file=sys.stderr,
+                )
+                continue
+            pending_article = article.copy()
+            pending_article["text"] = f"{text} (Page {index + 1})"
+            if note:
+                note = str(note)
+                pending_article["note"] = note
+                if note == ".h1" or note == ".h2" or note == ".h3":
+                    pending_article["text"] = text
+            finalize_article(result, pending_article)
+
+    return result
+
+
+def expand_pdf_inputs(input_args):
+    paths = []
+    for arg in input_args:
+        if os.path.isdir(arg):
+            paths.extend(
+                os.path.join(arg, name)
+                for name in sorted(os.listdir(arg))
+                if name.lower().endswith(".pdf")
+            )
+        else:
+            paths.append(arg)
+    return paths
+
+
+def is_pdf_input(arg):
+    return os.path.isdir(arg) or arg.lower().endswith(".pdf")
+
+
+def collect_pdf_files_highlights(paths):
+    result = []
+    with ProcessPoolExecutor() as executor:
+        for highlights in executor.map(collect_pdf_highlights, paths):
+            result.extend(highlights)
+    return result
+
+
 def main(args):
     dry_run = args[1] == "-n" if len(sys.argv) > 1 else False
     input_args = args[1:] if not dry_run else args[2:]
-    highlights = collect_highlights(fileinput.input(input_args))
+    if input_args and all(is_pdf_input(arg) for arg in input_args):
+        highlights = collect_pdf_files_highlights(expand_pdf_inputs(input_args))
+    else:
+        highlights = collect_highlights(utils.read_lines(input_args))
 
     if dry_run:
         print(json.dumps(highlights, indent=2, ensure_ascii=False))
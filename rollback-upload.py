@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+import argparse
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.error import HTTPError
+
+import utils
+
+LIST_UPLOADS = """
+SELECT
+    uploads.id,
+    uploads.started_at,
+    uploads.command,
+    count(upload_highlights.highlight_id),
+    coalesce(sum(upload_highlights.deleted), 0)
+FROM uploads
+LEFT JOIN upload_highlights ON upload_highlights.upload_id = uploads.id
+GROUP BY uploads.id
+ORDER BY uploads.id DESC
+LIMIT ?
+"""
+
+
+def list_uploads(conn, limit):
+    for id, started_at, command, count, deleted in conn.execute(LIST_UPLOADS, (limit,)):
+        status = f"{deleted}/{count} deleted" if deleted else f"{count} highlights"
+        print(f"{id:>5}  {started_at}  {status:<20}  {command}")
+
+
+def pending_ids(conn, upload_id, include_preexisting):
+    query = (
+        "SELECT highlight_id FROM upload_highlights"
+        " WHERE upload_id = ? AND deleted = 0"
+    )
+    if not include_preexisting:
+        query += " AND preexisting = 0"
+    return [id for (id,) in conn.execute(query + " ORDER BY highlight_id", (upload_id,))]
+
+
+def creation_times(client, ids, since):
+    """Map the IDs to when Readwise created them. A highlight created by the
+    upload and an older one it was merged into were both updated by it, so
+    both are in the export of highlights updated since it started."""
+    wanted = set(ids)
+    created = {}
+    for book in utils.fetch_export(client, updated_after=since):
+        for highlight in book["highlights"]:
+            if highlight["id"] in wanted:
+                created[highlight["id"]] = highlight["created_at"]
+    return created
+
+
+def confirm_created(conn, client, upload_id, ids):
+    """Split the IDs into those created by the upload, those created before
+    it, which are marked as preexisting, and those missing from the export."""
+    (started_at,) = conn.execute(
+        "SELECT started_at FROM uploads WHERE id = ?", (upload_id,)
+    ).fetchone()
+    start = datetime.fromisoformat(started_at)
+    created = creation_times(client, ids, started_at)
+    confirmed, earlier, missing = [], [], []
+    for id in ids:
+        if id not in created:
+            missing.append(id)
+        elif datetime.fromisoformat(created[id]) >= start:
+            confirmed.append(id)
+        else:
+            earlier.append(id)
+    with conn:
+        conn.executemany(
+            "UPDATE upload_highlights SET preexisting = 1"
+            " WHERE upload_id = ? AND highlight_id = ?",
+            ((upload_id, id) for id in earlier),
+        )
+    return confirmed, earlier, missing
+
+
+def delete_highlight(client, id):
+    try:
+        client.request("DELETE", f"/api/v2/highlights/{id}/")
+    except HTTPError as err:
+        # Already gone, e.g. deleted by hand or by an interrupted rollback
+        if err.code != 404:
+            raise
+    return id
+
+
+def rollback(conn, client, upload_id, ids, jobs):
+    """Delete highlights with up to `jobs` requests in flight, marking each as
+    deleted once it is, so an interrupted rollback picks up where it left."""
+    done = 0
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for id in executor.map(
+            lambda id: delete_highlight(client, id), ids, buffersize=jobs * 2
+        ):
+            conn.execute(
+                "UPDATE upload_highlights SET deleted = 1"
+                " WHERE upload_id = ? AND highlight_id = ?",
+                (upload_id, id),
+            )
+            done += 1
+            if done % 50 == 0:
+                conn.commit()
+                print(f"Deleted {done}/{len(ids)}...")
+    conn.execute(
+        "DELETE FROM readwise_ids WHERE id IN (SELECT highlight_id FROM"
+        " upload_highlights WHERE upload_id = ? AND deleted = 1)",
+        (upload_id,),
+    )
+    conn.commit()
+    return done
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Delete the highlights created by an upload from Readwise."
+    )
+    parser.add_argument(
+        "upload", nargs="?", type=int, help="Upload to roll back, see --list"
+    )
+    parser.add_argument("-l", "--list", action="store_true", help="List recent uploads")
+    parser.add_argument("-n", "--dry-run", action="store_true")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=8, help="Number of concurrent deletes"
+    )
+    parser.add_argument(
+        "--include-preexisting",
+        action="store_true",
+        help="Also delete highlights that existed before the upload and were "
+        "only updated by it, and skip checking when Readwise created them",
+    )
+    args = parser.parse_args()
+
+    conn = utils.open_store()
+    if args.list or args.upload is None:
+        list_uploads(conn, 20)
+        return
+
+    ids = pending_ids(conn, args.upload, args.include_preexisting)
+    if not ids:
+        print(f"Nothing left to delete for upload {args.upload}")
+        return
+
+    client = utils.ReadwiseClient()
+    try:
+        if not args.include_preexisting:
+            ids, earlier, missing = confirm_created(conn, client, args.upload, ids)
+            if earlier:
+                print(
+                    f"Skipping {len(earlier)} highlights created before the upload, "
+                    f"which only updated them: {earlier}"
+                )
+            if missing:
+                print(
+                    f"Skipping {len(missing)} highlights not updated since the upload "
+                    f"started, so not known to be created by it: {missing}"
+                )
+        if args.dry_run:
+            print(f"Would delete {len(ids)} highlights: {ids}")
+            return
+        done = rollback(conn, client, args.upload, ids, args.jobs)
+    except KeyboardInterrupt:
+        sys.exit("Interrupted, run again to resume")
+    finally:
+        conn.commit()
+        client.close()
+        conn.close()
+    print(f"Deleted {done} highlights of upload {args.upload}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+import argparse
+import sqlite3
+import sys
+
+import utils
+
+SEARCH = """
+SELECT
+    highlights.title,
+    highlights.author,
+    highlights.location,
+    snippet(highlights_fts, 0, '[', ']', '…', 24),
+    highlights.note
+FROM highlights_fts
+JOIN highlights ON highlights.id = highlights_fts.rowid
+WHERE highlights_fts MATCH ?
+ORDER BY rank
+LIMIT ?
+"""
+
+
+def search(conn, query, limit):
+    return conn.execute(SEARCH, (query, limit)).fetchall()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Full-text search over the local highlight store."
+    )
+    parser.add_argument(
+        "query",
+        nargs="*",
+        help="FTS5 query, columns can be selected with text:, note:, tags:, "
+        "author: and title:",
+    )
+    parser.add_argument("-l", "--limit", type=int, default=20)
+    parser.add_argument("--store", help="Path to the highlight store")
+    parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="Rebuild the full-text index and sketch highlights missing from the "
+        "near-duplicate index",
+    )
+    args = parser.parse_args()
+
+    conn = utils.open_store(args.store)
+    if args.rebuild:
+        with conn:
+            conn.execute("INSERT INTO highlights_fts (highlights_fts) VALUES ('rebuild')")
+        utils.reindex_sketches(conn)
+
+    if not args.query:
+        conn.close()
+        return
+    try:
+        rows = search(conn, " ".join(args.query), args.limit)
+    except sqlite3.OperationalError as err:
+        sys.exit(f"Invalid query: {err}")
+    for title, author, location, snippet, note in rows:
+        source = f"{author} - {title}" if author else title
+        if location:
+            source += f" ({location})"
+        print(source)
+        print(f"    {snippet}")
+        if note:
+            print(f"    > {note.splitlines()[0]}")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
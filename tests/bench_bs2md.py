@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""Render a synthetic Zotero note with the iterative bs2md and with the old
+recursive one, and report both times, e.g. `python tests/bench_bs2md.py 600`
+for the paragraphs of fixtures/zotero-marks.html repeated 600 times."""
+
+import sys
+import time
+from unittest import mock
+
+from test_bs2md import (
+    ITEM,
+    read_note,
+    recursive_bs2md,
+    reparsed_highlight_text,
+    zotero,
+)
+
+
+def generate(copies):
+    note = read_note()
+    start = note.index("<p>")
+    end = note.rindex("</p>") + len("</p>")
+    return note[:start] + "\n".join([note[start:end]] * copies) + note[end:]
+
+
+def collect(note):
+    highlights = []
+    start = time.perf_counter()
+    zotero.collect_highlights(ITEM, [note], highlights)
+    return highlights, time.perf_counter() - start
+
+
+def main(args):
+    if zotero is None:
+        sys.exit("requires Python 3.14")
+    copies = int(args[1]) if len(args) > 1 else 600
+    note = generate(copies)
+    highlights, iterative = collect(note)
+    with (
+        mock.patch.object(zotero, "bs2md", recursive_bs2md),
+        mock.patch.object(zotero, "get_highlight_text", reparsed_highlight_text),
+    ):
+        before, recursive = collect(note)
+    if highlights != before:
+        sys.exit("the renderings differ")
+    print(
+        f"{len(highlights)} highlights, {len(note) / 1e6:.1f} MB: "
+        f"iterative {iterative:.2f}s, recursive {recursive:.2f}s, "
+        f"{recursive / iterative:.1f}x"
+    )
+
+
+if __name__ == "__main__":
+    main(sys.argv)
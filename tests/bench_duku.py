@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""Parse a synthetic Duku anthology and report the throughput, e.g.
+`python tests/bench_duku.py 4000` for 4000 articles, about 90 MB."""
+
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+from scripts import load_script
+
+import utils
+
+duku = load_script("duku-to-readwise")
+
+
+def generate(path, articles):
+    """Write `articles` articles of 5 sections with 6 passages of random
+    length each, about 24 KB per article."""
+    rng = random.Random(0)
+    with open(path, "w", encoding="utf-8") as file:
+        file.write("<html><body><h1>读库 合集</h1>\n")
+        for article in range(articles):
+            file.write(
+                f"<h2>《文章 {article}》</h2>\n"
+                f"<p><strong>作者{article}</strong></p>\n<p>介绍文字</p>\n"
+            )
+            for section in range(5):
+                file.write(f"<h3>第{section}节</h3>\n")
+                for _ in range(6):
+                    passage = "这是一段很长的引文，" * rng.randint(5, 40)
+                    file.write(
+                        f"<blockquote><p>{passage}</p></blockquote>\n"
+                        + "<p>正文内容" * 3
+                        + "</p>\n"
+                    )
+        file.write("</body></html>\n")
+
+
+def main(args):
+    articles = int(args[1]) if len(args) > 1 else 4000
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "duku.html")
+        generate(path, articles)
+        size = os.path.getsize(path)
+        start = time.perf_counter()
+        count = sum(1 for _ in duku.collect_highlights(utils.read_lines([path])))
+        elapsed = time.perf_counter() - start
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(
+        f"{size / 1e6:.1f} MB, {count} highlights in {elapsed:.1f}s, "
+        f"{size / 1e6 / elapsed:.1f} MB/s, max RSS {rss:.0f} MB"
+    )
+
+
+if __name__ == "__main__":
+    main(sys.argv)
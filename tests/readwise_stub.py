@@ -0,0 +1,149 @@
+"""A local stand-in for the parts of the Readwise API the scripts use, served
+from a thread so tests can point utils.READWISE_URL at it."""
+
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+class ReadwiseStub:
+    """Highlights POSTed are merged into an existing one with the same book
+    and text, as Readwise does. The export is served `page_size` books at a
+    time, and the next `rate_limited` requests are answered with a 429."""
+
+    def __init__(self, page_size=100):
+        self.page_size = page_size
+        self.rate_limited = 0
+        self.highlights = {}
+        self.book_ids = {}
+        self.requests = []
+        self.lock = threading.Lock()
+        self.clock = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def reply(self, status, payload=None, headers=()):
+                body = b"" if payload is None else json.dumps(payload).encode()
+                self.send_response(status)
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def handle_request(self, method):
+                length = int(self.headers.get("Content-Length") or 0)
+                data = json.loads(self.rfile.read(length) or b"null")
+                url = urlsplit(self.path)
+                query = {k: v[0] for k, v in parse_qs(url.query).items()}
+                with stub.lock:
+                    stub.requests.append((method, url.path, query, data))
+                    if stub.rate_limited:
+                        stub.rate_limited -= 1
+                        return self.reply(429, {}, [("Retry-After", "0")])
+                    status, payload = stub.dispatch(method, url.path, query, data)
+                self.reply(status, payload)
+
+            def do_GET(self):
+                self.handle_request("GET")
+
+            def do_POST(self):
+                self.handle_request("POST")
+
+            def do_PATCH(self):
+                self.handle_request("PATCH")
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def tick(self):
+        """Timestamps that sort in the order of the changes."""
+        self.clock += 1
+        return f"2026-10-19T18:{self.clock // 60:02}:{self.clock % 60:02}.000Z"
+
+    def add(self, highlight):
+        book = (highlight.get("title"), highlight.get("author"))
+        for id, existing in self.highlights.items():
+            if (existing["title"], existing["author"], existing["text"]) == (
+                *book,
+                highlight["text"],
+            ):
+                break
+        else:
+            id = len(self.highlights) + 1
+            existing = self.highlights[id] = {"id": id, "created_at": self.tick()}
+        existing.update(highlight, author=book[1], updated_at=self.tick())
+        return id
+
+    def book_id(self, book):
+        return self.book_ids.setdefault(book, len(self.book_ids) + 1)
+
+    def dispatch(self, method, path, query, data):
+        if method == "POST" and path == "/api/v2/highlights/":
+            books = {}
+            for highlight in data["highlights"]:
+                book = (highlight.get("title"), highlight.get("author"))
+                item = books.setdefault(
+                    book,
+                    {
+                        "id": self.book_id(book),
+                        "title": book[0],
+                        "author": book[1],
+                        "modified_highlights": [],
+                    },
+                )
+                item["modified_highlights"].append(self.add(highlight))
+            return 200, list(books.values())
+
+        match = re.fullmatch(r"/api/v2/highlights/(\d+)/", path)
+        if method == "PATCH" and match:
+            existing = self.highlights.get(int(match[1]))
+            if existing is None:
+                return 404, {"detail": "Not found."}
+            existing.update(data, updated_at=self.tick())
+            return 200, existing
+
+        if method == "GET" and path == "/api/v2/export/":
+            ids = query["ids"].split(",") if "ids" in query else None
+            books = {}
+            for highlight in self.highlights.values():
+                if highlight["updated_at"] <= query.get("updatedAfter", ""):
+                    continue
+                book = (highlight["title"], highlight["author"])
+                if ids is not None and str(self.book_id(book)) not in ids:
+                    continue
+                books.setdefault(
+                    book,
+                    {
+                        "user_book_id": self.book_id(book),
+                        "title": book[0],
+                        "author": book[1],
+                        "highlights": [],
+                    },
+                )["highlights"].append(highlight)
+            results = list(books.values())
+            start = int(query.get("pageCursor", 0))
+            end = start + self.page_size
+            return 200, {
+                "count": len(results),
+                "nextPageCursor": str(end) if end < len(results) else None,
+                "results": results[start:end],
+            }
+
+        return 404, {"detail": "Not found."}
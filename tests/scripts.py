@@ -0,0 +1,19 @@
+import importlib.util
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, "tests", "fixtures")
+
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+def load_script(name):
+    """Import one of the hyphenated scripts as a module."""
+    spec = importlib.util.spec_from_file_location(
+        name.replace("-", "_"), os.path.join(ROOT, f"{name}.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,88 @@
+import os
+import unittest
+from unittest import mock
+
+from scripts import FIXTURES, load_script
+
+from bs4 import BeautifulSoup, NavigableString
+
+try:
+    zotero = load_script("zotero-annotations-to-readwise")
+except SyntaxError:
+    # The script uses Python 3.14 syntax
+    zotero = None
+
+ITEM = {
+    "title": "Marks",
+    "author": [{"given": "Ada", "family": "Lovelace"}],
+    "item-key": "ITEM0001",
+    "type": "book",
+}
+
+
+def read_note():
+    with open(os.path.join(FIXTURES, "zotero-marks.html"), encoding="utf-8") as file:
+        return file.read()
+
+
+def recursive_bs2md(bs):
+    """bs2md as it was before the iterative walk, less the image branch."""
+    if bs is None:
+        return ""
+    if isinstance(bs, NavigableString):
+        return str(bs)
+    if hasattr(bs, "name"):
+        inner = "".join(recursive_bs2md(child) for child in bs.children)
+        if bs.name in ["b", "strong"]:
+            return f"**{inner}**"
+        elif bs.name in ["i", "em", "emph"]:
+            return f"*{inner}*"
+        elif bs.name == "code":
+            return f"`{inner}`"
+        else:
+            return inner
+    return bs.get_text()
+
+
+def reparsed_highlight_text(highlight):
+    """get_highlight_text as it was, serializing and parsing the span again."""
+    text = recursive_bs2md(
+        BeautifulSoup(zotero.replace_br(highlight), "html.parser")
+    ).strip()
+    if text.startswith("“") and text.endswith("”"):
+        return text[1:-1]
+    return text
+
+
+@unittest.skipIf(zotero is None, "requires Python 3.14")
+class Bs2mdTest(unittest.TestCase):
+    def test_matches_the_recursive_rendering_of_every_tag(self):
+        soup = BeautifulSoup(zotero.replace_br(read_note()), "html.parser")
+        for tag in soup.find_all(True):
+            self.assertEqual(zotero.bs2md(tag), recursive_bs2md(tag), str(tag))
+
+    def test_collects_the_same_highlights_as_before(self):
+        note = read_note()
+        highlights = []
+        zotero.collect_highlights(ITEM, [note], highlights)
+        before = []
+        with (
+            mock.patch.object(zotero, "bs2md", recursive_bs2md),
+            mock.patch.object(zotero, "get_highlight_text", reparsed_highlight_text),
+        ):
+            zotero.collect_highlights(ITEM, [note], before)
+        self.assertEqual(highlights, before)
+        self.assertEqual(
+            [(h["text"], h.get("note")) for h in highlights[:2]],
+            [
+                (
+                    "Plain **bold *bold italic `code`* back** plain",
+                    "A *comment* with **strong** text",
+                ),
+                ("Line one\nline two\nline three\nline four", "Comment\noverlines"),
+            ],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,27 @@
+import unittest
+
+from scripts import load_script
+
+csv_to_readwise = load_script("csv-to-readwise")
+
+
+class CollectHighlightsTest(unittest.TestCase):
+    def test_skips_blank_rows(self):
+        lines = [
+            "Highlight,Title,Location\n",
+            "first,Book,12\n",
+            "\n",
+            ",,\n",
+            "second,Book,\n",
+        ]
+        self.assertEqual(
+            list(csv_to_readwise.collect_highlights(lines)),
+            [
+                {"text": "first", "title": "Book", "location": 12, "location_type": "page"},
+                {"text": "second", "title": "Book"},
+            ],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
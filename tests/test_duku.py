@@ -0,0 +1,56 @@
+import os
+import unittest
+
+from scripts import FIXTURES, load_script
+
+duku = load_script("duku-to-readwise")
+
+
+class CollectHighlightsTest(unittest.TestCase):
+    def test_fixture(self):
+        with open(os.path.join(FIXTURES, "duku.html"), encoding="utf-8") as file:
+            highlights = list(duku.collect_highlights(file))
+
+        self.assertEqual(
+            [(h["title"], h["author"], h["text"], h.get("note")) for h in highlights],
+            [
+                ("读库 2301", None, "卷首语", None),
+                ("读库 - 远行的人", "张三", "第一段引文。", None),
+                ("读库 - 远行的人", "张三", "第二段引文。", None),
+                ("读库 - 远行的人", "张三", "一、开始", ".h1"),
+                ("读库 - 远行的人", "张三", "直接的引文", None),
+                ("读库 - 远行的人", "张三", "换行后的引文", None),
+                ("读库 - 远行的人", "张三", "小节", ".h2"),
+                (
+                    "读库 - 远行的人",
+                    "张三",
+                    "A & B quoted passage, across “two” lines.",
+                    None,
+                ),
+                ("读库 - 没有书名号", None, "无作者的引文。", None),
+                ("读库 - 没有书名号", None, "引文之后的粗体不是作者。", None),
+            ],
+        )
+        self.assertTrue(
+            all(h["source_type"] == "Duku" and h["category"] == "books" for h in highlights)
+        )
+
+    def test_skips_passages_without_a_title(self):
+        html = "<blockquote><p>无卷</p></blockquote><h2>文章</h2><blockquote>引文</blockquote>"
+        self.assertEqual(
+            [(h["title"], h["text"]) for h in duku.collect_highlights([html])],
+            [("读库 - 文章", "引文")],
+        )
+
+    def test_chunk_boundaries(self):
+        with open(os.path.join(FIXTURES, "duku.html"), encoding="utf-8") as file:
+            html = file.read()
+        expected = list(duku.collect_highlights([html]))
+        for size in (1, 7, 64):
+            with self.subTest(size=size):
+                chunks = [html[i : i + size] for i in range(0, len(html), size)]
+                self.assertEqual(list(duku.collect_highlights(chunks)), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,145 @@
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from scripts import ROOT
+
+ENTRIES = [
+    {
+        "text": "First highlight of the book.",
+        "title": "Book 1",
+        "author": "Author 1",
+        "source_url": "https://example.com/book-1",
+        "location": 1,
+        "location_type": "page",
+        "note": "",
+    },
+    # Same title and author from another source, so the same note
+    {
+        "text": "A highlight from another copy.",
+        "title": "Book 1",
+        "author": "Author 1",
+        "source_url": "https://example.com/book-1-copy",
+        "location": 7,
+        "location_type": "page",
+        "note": "",
+    },
+    {
+        "text": "Alone in its note.",
+        "title": "Book 2",
+        "author": "Author 2",
+        "source_url": "https://example.com/book-2",
+        "location": 3,
+        "location_type": "page",
+        "note": ".favorite",
+    },
+]
+
+# Both hash to block IDs starting with 0bf02cba
+COLLIDING = [
+    {
+        "text": "Highlight number 49806.",
+        "title": "Book 1",
+        "author": "Author 1",
+        "location": 1,
+        "location_type": "page",
+        "note": "",
+    },
+    {
+        "text": "Highlight number 20574.",
+        "title": "Book 2",
+        "author": "Author 2",
+        "location": 1,
+        "location_type": "page",
+        "note": "",
+    },
+]
+
+
+class JsonToMarkdownTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        self.input = os.path.join(self.tmp, "export.json")
+        with open(self.input, "w", encoding="utf-8") as handle:
+            json.dump(ENTRIES, handle)
+        self.output = os.path.join(self.tmp, "vault")
+
+    def run_script(self, *args):
+        result = subprocess.run(
+            [sys.executable, os.path.join(ROOT, "json-to-markdown.py"), *args],
+            env=dict(os.environ, READWISE_STORE=os.path.join(self.tmp, "store.sqlite")),
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        return result.stdout.strip().splitlines()[-1]
+
+    def block_ids(self):
+        ids = {}
+        for name in sorted(os.listdir(self.output)):
+            if name.endswith(".md"):
+                with open(os.path.join(self.output, name), encoding="utf-8") as handle:
+                    ids[name] = re.findall(r"\^([0-9a-f]{8,40})$", handle.read(), re.M)
+        return ids
+
+    def note_mtimes(self):
+        return {
+            name: os.stat(os.path.join(self.output, name)).st_mtime_ns
+            for name in os.listdir(self.output)
+            if name.endswith(".md")
+        }
+
+    def test_second_run_leaves_notes_unchanged(self):
+        self.assertEqual(
+            self.run_script(self.input, "-o", self.output, "-j", "1"),
+            "2 created, 0 updated, 0 unchanged",
+        )
+        mtimes = self.note_mtimes()
+        self.assertEqual(
+            sorted(mtimes),
+            ["Author 1 - Book 1 (Highlights).md", "Author 2 - Book 2 (Highlights).md"],
+        )
+        with open(
+            os.path.join(self.output, "Author 1 - Book 1 (Highlights).md"),
+            encoding="utf-8",
+        ) as handle:
+            # The last group sharing the filename wins
+            self.assertIn("A highlight from another copy.", handle.read())
+
+        self.assertEqual(
+            self.run_script(self.input, "-o", self.output, "-j", "1"),
+            "0 created, 0 updated, 2 unchanged",
+        )
+        self.assertEqual(self.note_mtimes(), mtimes)
+
+    def test_colliding_block_ids_across_notes_stay_distinct(self):
+        with open(self.input, "w", encoding="utf-8") as handle:
+            json.dump(COLLIDING, handle)
+        self.run_script(self.input, "-o", self.output, "-j", "1")
+        ids = self.block_ids()
+        self.assertEqual(
+            sorted(ids),
+            ["Author 1 - Book 1 (Highlights).md", "Author 2 - Book 2 (Highlights).md"],
+        )
+        first, second = sorted(block_id for found in ids.values() for block_id in found)
+        self.assertEqual(first, "0bf02cba")
+        self.assertEqual(len(second), 9)
+        self.assertTrue(second.startswith(first))
+
+        # Rebuilt from the IDs in the notes, the registry hands them out again
+        os.remove(os.path.join(self.output, ".readwise-block-ids.json"))
+        self.assertEqual(
+            self.run_script(self.input, "-o", self.output, "-j", "1"),
+            "0 created, 0 updated, 2 unchanged",
+        )
+        self.assertEqual(self.block_ids(), ids)
+
+
+if __name__ == "__main__":
+    unittest.main()
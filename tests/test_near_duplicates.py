@@ -0,0 +1,74 @@
+import io
+import os
+import tempfile
+import unittest
+from contextlib import redirect_stderr
+from unittest import mock
+
+from scripts import ROOT  # noqa: F401
+
+import utils
+
+PASSAGE = (
+    "The best way to get a good idea is to have a lot of ideas, and then to "
+    "throw away the bad ones without regret."
+)
+
+
+def highlight(text, title="Ideas", note=""):
+    return {"title": title, "author": "Linus", "text": text, "note": note}
+
+
+class NearDuplicatesTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, "store.sqlite")
+        patcher = mock.patch.object(utils, "HIGHLIGHT_STORE", path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        utils.store_highlights([highlight(PASSAGE)])
+
+    def filter(self, highlights, mode="drop"):
+        with redirect_stderr(io.StringIO()):
+            return utils.filter_near_duplicates(highlights, mode)
+
+    def test_exact_reimport_is_left_to_readwise(self):
+        batch = [highlight(PASSAGE)]
+        self.assertEqual(self.filter(batch), batch)
+
+    def test_reformatted_passage_is_dropped(self):
+        reformatted = highlight(
+            "“The best way to get a good idea is to have a lot of ideas — and "
+            "then to throw away the bad ones without regret” (p. 12)",
+            title="ideas: a subtitle",
+        )
+        self.assertEqual(self.filter([reformatted]), [])
+        self.assertEqual(self.filter([reformatted], "flag"), [reformatted])
+
+    def test_unrelated_text_is_kept(self):
+        batch = [
+            highlight("Simplicity is prerequisite for reliability in any large system."),
+            highlight(PASSAGE, title="Another book"),
+        ]
+        self.assertEqual(self.filter(batch), batch)
+
+    def test_matched_highlights_do_not_match_later_ones(self):
+        near = highlight(PASSAGE.replace("regret", "any regret"))
+        exact = highlight(PASSAGE)
+        self.assertEqual(self.filter([near, exact]), [exact])
+
+    def test_duplicates_within_a_batch(self):
+        first = highlight("A completely new passage that nobody has highlighted before.")
+        again = highlight("a completely new passage, that nobody has highlighted before")
+        self.assertEqual(self.filter([first, again]), [first])
+
+    def test_split_pieces_are_never_dropped(self):
+        pieces = utils.split_highlight(highlight(PASSAGE.replace(" ", "  ") + " " + "x" * 8191))
+        self.assertGreater(len(pieces), 1)
+        pieces[0]["text"] = PASSAGE.upper()
+        self.assertEqual(self.filter(pieces), pieces)
+
+
+if __name__ == "__main__":
+    unittest.main()
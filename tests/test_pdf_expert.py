@@ -0,0 +1,214 @@
+import io
+import os
+import tempfile
+import unittest
+from contextlib import redirect_stderr
+
+from scripts import load_script
+
+from pypdf import PdfWriter
+from pypdf.generic import (
+    ArrayObject,
+    DecodedStreamObject,
+    DictionaryObject,
+    FloatObject,
+    NameObject,
+    NumberObject,
+    TextStringObject,
+)
+
+pdf_expert = load_script("pdf-expert-to-readwise")
+
+LINES = ["The quick brown fox jumps over", "the lazy dog and runs away."]
+# Helvetica widths from its AFM, for the printable ASCII characters
+HELVETICA = [
+    278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278,
+    278, 556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584,
+    584, 556, 1015, 667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556,
+    833, 722, 778, 667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 278,
+    278, 278, 469, 556, 333, 556, 556, 500, 556, 556, 278, 556, 556, 222, 222,
+    500, 222, 833, 556, 556, 556, 556, 333, 500, 278, 556, 500, 722, 500, 500,
+    500, 334, 260, 334, 584,
+]
+WIDTHS = {chr(32 + i): width for i, width in enumerate(HELVETICA)}
+
+
+def x_at(line, count, origin=72):
+    text = LINES[line][:count]
+    return origin + sum(WIDTHS[c] for c in text) * 12 / 1000
+
+
+def quad(x0, x1, baseline):
+    return [x0, baseline + 10, x1, baseline + 10, x0, baseline - 3, x1, baseline - 3]
+
+
+def stream_of(writer, data, entries=None):
+    stream = DecodedStreamObject()
+    stream.set_data(data)
+    for key, value in (entries or {}).items():
+        stream[NameObject(key)] = value
+    return writer._add_object(stream)
+
+
+def helvetica():
+    return DictionaryObject(
+        {
+            NameObject("/Type"): NameObject("/Font"),
+            NameObject("/Subtype"): NameObject("/Type1"),
+            NameObject("/BaseFont"): NameObject("/Helvetica"),
+            NameObject("/FirstChar"): NumberObject(32),
+            NameObject("/LastChar"): NumberObject(126),
+            NameObject("/Widths"): ArrayObject(NumberObject(w) for w in HELVETICA),
+        }
+    )
+
+
+def identity_font(writer, to_unicode):
+    """A Type0 font with two-byte codes, each 500 wide, mapped to text by a
+    ToUnicode CMap."""
+    descendant = DictionaryObject(
+        {
+            NameObject("/Type"): NameObject("/Font"),
+            NameObject("/Subtype"): NameObject("/CIDFontType2"),
+            NameObject("/BaseFont"): NameObject("/SongTi"),
+            NameObject("/DW"): NumberObject(500),
+        }
+    )
+    return DictionaryObject(
+        {
+            NameObject("/Type"): NameObject("/Font"),
+            NameObject("/Subtype"): NameObject("/Type0"),
+            NameObject("/BaseFont"): NameObject("/SongTi"),
+            NameObject("/Encoding"): NameObject("/Identity-H"),
+            NameObject("/DescendantFonts"): ArrayObject([descendant]),
+            NameObject("/ToUnicode"): stream_of(writer, to_unicode.encode()),
+        }
+    )
+
+
+def build_pdf(path, content, quads_list, forms=None, to_unicode=None):
+    writer = PdfWriter()
+    page = writer.add_blank_page(612, 792)
+    fonts = DictionaryObject({NameObject("/F1"): helvetica()})
+    if to_unicode:
+        fonts[NameObject("/F2")] = identity_font(writer, to_unicode)
+    resources = DictionaryObject({NameObject("/Font"): fonts})
+    if forms:
+        resources[NameObject("/XObject")] = DictionaryObject(
+            {
+                NameObject(name): stream_of(
+                    writer,
+                    data.encode("latin-1"),
+                    {
+                        "/Type": NameObject("/XObject"),
+                        "/Subtype": NameObject("/Form"),
+                        "/BBox": ArrayObject(NumberObject(v) for v in (0, 0, 612, 792)),
+                        "/Matrix": ArrayObject(NumberObject(v) for v in matrix),
+                        "/Resources": DictionaryObject({NameObject("/Font"): fonts}),
+                    },
+                )
+                for name, (data, matrix) in forms.items()
+            }
+        )
+    page[NameObject("/Resources")] = resources
+    page[NameObject("/Contents")] = stream_of(writer, content.encode("latin-1"))
+
+    annots = ArrayObject()
+    for quads, note in quads_list:
+        annot = DictionaryObject(
+            {
+                NameObject("/Type"): NameObject("/Annot"),
+                NameObject("/Subtype"): NameObject("/Highlight"),
+                NameObject("/Rect"): ArrayObject(
+                    FloatObject(v)
+                    for v in (
+                        min(quads[0::2]),
+                        min(quads[1::2]),
+                        max(quads[0::2]),
+                        max(quads[1::2]),
+                    )
+                ),
+                NameObject("/QuadPoints"): ArrayObject(FloatObject(v) for v in quads),
+            }
+        )
+        if note:
+            annot[NameObject("/Contents")] = TextStringObject(note)
+        annots.append(writer._add_object(annot))
+    page[NameObject("/Annots")] = annots
+    writer.write(path)
+
+
+class CollectPdfHighlightsTest(unittest.TestCase):
+    def collect(self, content, quads_list, **kwargs):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "Author - Title.pdf")
+            build_pdf(path, content, quads_list, **kwargs)
+            stderr = io.StringIO()
+            with redirect_stderr(stderr):
+                highlights = pdf_expert.collect_pdf_highlights(path)
+        return [(h["text"], h.get("note")) for h in highlights], stderr.getvalue()
+
+    def test_clips_to_glyphs_inside_quads(self):
+        content = (
+            f"BT /F1 12 Tf 72 700 Td ({LINES[0]}) Tj 0 -14 Td ({LINES[1]}) Tj ET"
+        )
+        highlights, stderr = self.collect(
+            content,
+            [
+                (quad(x_at(0, 10), x_at(0, 19), 700), None),
+                (
+                    quad(x_at(0, 20), x_at(0, len(LINES[0])), 700)
+                    + quad(72, x_at(1, 12), 686),
+                    "a note",
+                ),
+                (quad(x_at(1, 0), x_at(1, 3), 686), ".h1"),
+            ],
+        )
+        self.assertEqual(
+            highlights,
+            [
+                ("brown fox (Page 1)", None),
+                ("jumps over the lazy dog (Page 1)", "a note"),
+                ("the", ".h1"),
+            ],
+        )
+        self.assertEqual(stderr, "")
+
+    def test_kerned_words_are_split_on_gaps(self):
+        content = "BT /F1 12 Tf 72 700 Td [(quick) -280 (brown) -280 (fox)] TJ ET"
+        width = sum(WIDTHS[c] for c in "quickbrownfox") * 12 / 1000 + 2 * 280 * 12 / 1000
+        highlights, _ = self.collect(content, [(quad(72, 72 + width, 700), None)])
+        self.assertEqual(highlights, [("quick brown fox (Page 1)", None)])
+
+    def test_reads_text_inside_form_xobjects(self):
+        form = f"BT /F1 12 Tf 0 0 Td ({LINES[0]}) Tj ET"
+        content = "q 1 0 0 1 0 600 cm /Fm1 Do Q"
+        highlights, stderr = self.collect(
+            content,
+            [(quad(x_at(0, 10, 100), x_at(0, 19, 100), 600), None)],
+            forms={"/Fm1": (form, [1, 0, 0, 1, 100, 0])},
+        )
+        self.assertEqual(highlights, [("brown fox (Page 1)", None)])
+        self.assertEqual(stderr, "")
+
+    def test_maps_two_byte_codes_through_to_unicode(self):
+        to_unicode = (
+            "begincmap 1 begincodespacerange <0000> <FFFF> endcodespacerange "
+            "2 beginbfchar <0001> <4E2D> <0002> <6587> endbfchar "
+            "1 beginbfrange <0003> <0004> <4E66> endbfrange endcmap"
+        )
+        content = "BT /F2 12 Tf 72 700 Td <0001000200030004> Tj ET"
+        highlights, _ = self.collect(
+            content, [(quad(72 + 6, 72 + 18, 700), None)], to_unicode=to_unicode
+        )
+        self.assertEqual(highlights, [("文书 (Page 1)", None)])
+
+    def test_skips_annotations_without_text(self):
+        content = f"BT /F1 12 Tf 72 700 Td ({LINES[0]}) Tj ET"
+        highlights, stderr = self.collect(content, [(quad(300, 400, 500), None)])
+        self.assertEqual(highlights, [])
+        self.assertIn("no text under an annotation on page 1", stderr)
+
+
+if __name__ == "__main__":
+    unittest.main()
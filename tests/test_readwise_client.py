@@ -0,0 +1,82 @@
+import io
+import unittest
+from contextlib import redirect_stderr, redirect_stdout
+from unittest import mock
+from urllib.error import HTTPError
+
+from readwise_stub import ReadwiseStub
+from scripts import load_script
+
+import utils
+
+json_to_markdown = load_script("json-to-markdown")
+
+
+def highlight(text, title, author="Linus"):
+    return {"title": title, "author": author, "text": text, "note": ""}
+
+
+class FetchExportTest(unittest.TestCase):
+    def setUp(self):
+        self.stub = ReadwiseStub(page_size=2)
+        self.enterContext(self.stub)
+        self.enterContext(mock.patch.object(utils, "READWISE_URL", self.stub.url))
+        # Readwise allows 20 export requests a minute, not the stand-in
+        self.enterContext(
+            mock.patch.object(utils, "EXPORT_LIMITER", utils.RateLimiter(1000, 1.0))
+        )
+        self.client = utils.ReadwiseClient("token", "tests")
+        self.addCleanup(self.client.close)
+
+    def exports(self):
+        return [
+            query
+            for _, path, query, _ in self.stub.requests
+            if path == "/api/v2/export/"
+        ]
+
+    def test_follows_page_cursors(self):
+        for book in range(5):
+            self.stub.add(highlight("text", f"Book {book}"))
+        books = list(utils.fetch_export(self.client))
+        self.assertEqual([b["title"] for b in books], [f"Book {b}" for b in range(5)])
+        self.assertEqual(self.exports(), [{}, {"pageCursor": "2"}, {"pageCursor": "4"}])
+
+    def test_refetches_books_changed_after_in_full(self):
+        self.stub.add(highlight("one", "Changed"))
+        self.stub.add(highlight("two", "Changed"))
+        self.stub.add(highlight("three", "Unchanged"))
+        updated_after = self.stub.highlights[3]["updated_at"]
+        self.stub.add(dict(highlight("two", "Changed"), note="edited"))
+
+        with redirect_stdout(io.StringIO()) as stdout:
+            entries = list(json_to_markdown.fetch_entries(self.client, updated_after))
+        self.assertEqual(stdout.getvalue(), f"1 books changed since {updated_after}\n")
+        self.assertEqual(
+            [(e["title"], e["text"], e["note"]) for e in entries],
+            [("Changed", "one", ""), ("Changed", "two", "edited")],
+        )
+        self.assertEqual(self.exports(), [{"updatedAfter": updated_after}, {"ids": "1"}])
+
+    def test_waits_out_rate_limits(self):
+        self.stub.add(highlight("one", "Book"))
+        self.stub.rate_limited = 2
+        stderr = io.StringIO()
+        with redirect_stderr(stderr):
+            books = list(utils.fetch_export(self.client))
+        self.assertEqual([b["title"] for b in books], ["Book"])
+        self.assertEqual(len(self.exports()), 3)
+        self.assertEqual(stderr.getvalue().count("Rate limited. Retry after: 0.0"), 2)
+
+    def test_gives_up_after_the_retries(self):
+        client = utils.ReadwiseClient("token", "tests", retries=1)
+        self.addCleanup(client.close)
+        self.stub.rate_limited = 5
+        with redirect_stderr(io.StringIO()), self.assertRaises(HTTPError) as raised:
+            list(utils.fetch_export(client))
+        self.assertEqual(raised.exception.code, 429)
+        self.assertEqual(len(self.exports()), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
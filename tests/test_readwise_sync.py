@@ -0,0 +1,175 @@
+import io
+import os
+import tempfile
+import unittest
+from contextlib import redirect_stderr, redirect_stdout
+from unittest import mock
+
+from readwise_stub import ReadwiseStub
+from scripts import ROOT  # noqa: F401
+
+import utils
+
+
+def highlight(text, title="Ideas", author="Linus", **fields):
+    return {"title": title, "author": author, "text": text, **fields}
+
+
+def stored_ids():
+    conn = utils.open_store()
+    try:
+        return dict(conn.execute("SELECT key, id FROM readwise_ids"))
+    finally:
+        conn.close()
+
+
+class StoreTestCase(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, "store.sqlite")
+        patcher = mock.patch.object(utils, "HIGHLIGHT_STORE", path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class ReadwiseKeyTest(unittest.TestCase):
+    def test_ignores_positions_from_auto_numbering(self):
+        first = highlight("A passage.", location=1, location_type="order")
+        shifted = highlight("A passage.", location=4, location_type="order")
+        self.assertEqual(utils.readwise_key(first), utils.readwise_key(shifted))
+        self.assertEqual(
+            utils.readwise_key(first), utils.readwise_key(highlight("A passage."))
+        )
+
+    def test_source_locations_tell_repeated_text_apart(self):
+        self.assertNotEqual(
+            utils.readwise_key(highlight("Ibid.", location=3, location_type="page")),
+            utils.readwise_key(highlight("Ibid.", location=9, location_type="page")),
+        )
+
+    def test_normalizes_text_and_ignores_the_note(self):
+        self.assertEqual(
+            utils.readwise_key(highlight("Hello,  World!", note="old")),
+            utils.readwise_key(highlight("hello world", note="new")),
+        )
+
+    def test_differs_between_books(self):
+        self.assertNotEqual(
+            utils.readwise_key(highlight("A passage.")),
+            utils.readwise_key(highlight("A passage.", title="Other")),
+        )
+
+
+class RecordReadwiseIdsTest(StoreTestCase):
+    def test_matches_ids_per_book_in_order(self):
+        sent = [
+            highlight("one"),
+            highlight("two", title="Other", author="Ada"),
+            highlight("three"),
+        ]
+        items = [
+            {"title": "Other", "author": "Ada", "modified_highlights": [20]},
+            {"title": "Ideas", "author": "Linus", "modified_highlights": [10, 30]},
+        ]
+        utils.record_readwise_ids(sent, items)
+        self.assertEqual(
+            stored_ids(),
+            {
+                utils.readwise_key(sent[0]): 10,
+                utils.readwise_key(sent[1]): 20,
+                utils.readwise_key(sent[2]): 30,
+            },
+        )
+
+    def test_skips_books_whose_id_count_differs(self):
+        sent = [highlight("one"), highlight("two"), highlight("three", title="Other")]
+        items = [
+            {"title": "Ideas", "author": "Linus", "modified_highlights": [10]},
+            {"title": "Other", "author": "Linus", "modified_highlights": [30]},
+        ]
+        stderr = io.StringIO()
+        with redirect_stderr(stderr):
+            utils.record_readwise_ids(sent, items)
+        self.assertIn("Cannot match 1 IDs to 2 highlights of Ideas", stderr.getvalue())
+        self.assertEqual(stored_ids(), {utils.readwise_key(sent[2]): 30})
+
+
+class SyncHighlightsTest(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.stub = ReadwiseStub()
+        self.enterContext(self.stub)
+        self.enterContext(mock.patch.object(utils, "READWISE_URL", self.stub.url))
+        self.enterContext(mock.patch.object(utils, "SYNC", True))
+        self.enterContext(mock.patch.object(utils, "NEAR_DUPLICATES", "off"))
+
+    def create(self, highlights):
+        with redirect_stdout(io.StringIO()):
+            utils.create_highlights(highlights, "token", "tests")
+
+    def methods(self):
+        # PATCHes run in parallel
+        methods = sorted(request[:2] for request in self.stub.requests)
+        self.stub.requests.clear()
+        return methods
+
+    def test_patches_changed_highlights_and_posts_new_ones(self):
+        self.create([highlight("one", note="a"), highlight("two"), highlight("three")])
+        self.assertEqual(self.methods(), [("POST", "/api/v2/highlights/")])
+        self.assertEqual(len(stored_ids()), 3)
+
+        # A highlight added in front renumbers the others, which are moved
+        # rather than created again
+        self.create(
+            [
+                highlight("zero"),
+                highlight("one", note="b"),
+                highlight("two"),
+                highlight("three"),
+            ]
+        )
+        self.assertEqual(
+            self.methods(),
+            [
+                ("PATCH", "/api/v2/highlights/1/"),
+                ("PATCH", "/api/v2/highlights/2/"),
+                ("PATCH", "/api/v2/highlights/3/"),
+                ("POST", "/api/v2/highlights/"),
+            ],
+        )
+        self.assertEqual(
+            [
+                (h["text"], h.get("note", ""), h["location"])
+                for h in self.stub.highlights.values()
+            ],
+            [("one", "b", 2), ("two", "", 3), ("three", "", 4), ("zero", "", 1)],
+        )
+        self.assertEqual(len(stored_ids()), 4)
+
+        self.create(
+            [
+                highlight("zero"),
+                highlight("one", note="b"),
+                highlight("two"),
+                highlight("three"),
+            ]
+        )
+        self.assertEqual(self.methods(), [])
+
+    def test_posts_again_highlights_deleted_on_readwise(self):
+        self.create([highlight("one")])
+        self.methods()
+        del self.stub.highlights[1]
+        self.create([highlight("one", note="changed")])
+        self.assertEqual(
+            self.methods(),
+            [("PATCH", "/api/v2/highlights/1/"), ("POST", "/api/v2/highlights/")],
+        )
+        self.assertEqual(
+            [h["note"] for h in self.stub.highlights.values()], ["changed"]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
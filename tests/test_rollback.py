@@ -0,0 +1,61 @@
+import os
+import tempfile
+import unittest
+
+from scripts import load_script
+
+import utils
+
+rollback = load_script("rollback-upload")
+
+
+class ExportClient:
+    """Serves one export page of highlights updated since the upload."""
+
+    def __init__(self, highlights):
+        self.highlights = highlights
+        self.params = None
+
+    def get(self, path, params=None, limiter=None):
+        self.params = dict(params)
+        return {
+            "results": [{"title": "Book", "highlights": self.highlights}],
+            "nextPageCursor": None,
+        }
+
+
+class ConfirmCreatedTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.conn = utils.open_store(os.path.join(tmp.name, "store.sqlite"))
+        self.addCleanup(self.conn.close)
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO uploads VALUES (1, '2026-10-19T18:00:00Z', 'upload')"
+            )
+            self.conn.executemany(
+                "INSERT INTO upload_highlights (upload_id, highlight_id) VALUES (1, ?)",
+                [(1,), (2,), (3,)],
+            )
+
+    def test_skips_highlights_not_created_by_the_upload(self):
+        client = ExportClient(
+            [
+                # Merged into by the upload
+                {"id": 1, "created_at": "2026-10-01T09:00:00.000Z"},
+                {"id": 2, "created_at": "2026-10-19T18:00:03.412Z"},
+                {"id": 4, "created_at": "2026-10-19T18:30:00.000Z"},
+            ]
+        )
+        ids = rollback.pending_ids(self.conn, 1, False)
+        confirmed, earlier, missing = rollback.confirm_created(self.conn, client, 1, ids)
+
+        self.assertEqual(client.params["updatedAfter"], "2026-10-19T18:00:00Z")
+        self.assertEqual((confirmed, earlier, missing), ([2], [1], [3]))
+        self.assertEqual(rollback.pending_ids(self.conn, 1, False), [2, 3])
+        self.assertEqual(rollback.pending_ids(self.conn, 1, True), [1, 2, 3])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+import io
+import os
+import sys
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+from unittest import mock
+
+from scripts import load_script
+
+import utils
+
+search_highlights = load_script("search-highlights")
+
+HIGHLIGHTS = [
+    {
+        "title": "Sketches",
+        "author": "Ada Lovelace",
+        "text": "The engine weaves algebraic patterns just as the loom weaves flowers.",
+        "note": ".favorite .math\nOn the analytical engine",
+        "location": 12,
+    },
+    {
+        "title": "Ideas",
+        "author": "Linus Pauling",
+        "text": "The best way to have a good idea is to have lots of ideas.",
+        "note": "",
+    },
+    {
+        "title": "Patterns",
+        "author": "Christopher Alexander",
+        "text": "Each pattern describes a problem which occurs over and over again.",
+        "note": ".favorite",
+    },
+]
+
+
+class SearchHighlightsTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, "store.sqlite")
+        self.conn = utils.open_store(self.path)
+        self.addCleanup(self.conn.close)
+        utils.store_highlights(HIGHLIGHTS, self.conn)
+
+    def titles(self, query):
+        return [row[0] for row in search_highlights.search(self.conn, query, 20)]
+
+    def run_main(self, *args):
+        stdout = io.StringIO()
+        argv = ["search-highlights.py", "--store", self.path, *args]
+        with mock.patch.object(sys, "argv", argv), redirect_stdout(stdout):
+            search_highlights.main()
+        return stdout.getvalue()
+
+    def test_matches_text_and_columns(self):
+        self.assertEqual(self.titles("ideas"), ["Ideas"])
+        self.assertEqual(sorted(self.titles("pattern*")), ["Patterns", "Sketches"])
+        self.assertEqual(sorted(self.titles("tags:favorite")), ["Patterns", "Sketches"])
+        self.assertEqual(self.titles("tags:math"), ["Sketches"])
+        self.assertEqual(self.titles("author:lovelace"), ["Sketches"])
+        self.assertEqual(self.titles("author:lovelace AND text:idea"), [])
+
+    def test_prints_source_snippet_and_note(self):
+        self.assertEqual(
+            self.run_main("loom"),
+            "Ada Lovelace - Sketches (12)\n"
+            "    The engine weaves algebraic patterns just as the [loom] weaves flowers.\n"
+            "    > .favorite .math\n",
+        )
+
+    def test_invalid_query_exits(self):
+        with self.assertRaises(SystemExit) as raised:
+            self.run_main("author:", "(")
+        self.assertTrue(str(raised.exception.code).startswith("Invalid query: "))
+
+    def test_rebuild_restores_the_indexes(self):
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO highlights_fts (highlights_fts) VALUES ('delete-all')"
+            )
+            self.conn.execute("DELETE FROM sketches")
+        self.assertEqual(self.titles("ideas"), [])
+
+        self.assertEqual(self.run_main("--rebuild"), "")
+        self.assertEqual(self.titles("ideas"), ["Ideas"])
+        self.assertEqual(
+            self.conn.execute("SELECT count(*) FROM sketches").fetchone()[0],
+            len(HIGHLIGHTS),
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
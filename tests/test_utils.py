@@ -0,0 +1,82 @@
+import io
+import json
+import os
+import tempfile
+import unittest
+
+from scripts import ROOT  # noqa: F401
+
+import utils
+
+DOCUMENT = """{"version": 2.5e0, "records": [
+  {"id": 1, "score": 1.5, "big": 2e10, "small": -3.25E-4, "neg": -0,
+   "text": "tab\\tquote\\" slash\\\\ \\u4e2d\\u6587 \\ud83d\\ude00",
+   "tags": [12345678901234567890, 0.5, 6E+2, true, false, null]},
+  {"nested": {"list": [1.0, [2e-3, {"x": -7.125}]], "empty": {}, "none": []}},
+  3.14159, 42, "end"
+], "meta": {"rate": 1E-2, "count": 10, "label": "caf\\u00e9 \\n"}}"""
+
+
+def walk(stream):
+    char = stream.peek()
+    if char == "[":
+        return list(stream.items())
+    if char == "{":
+        return {key: walk(stream) for key in stream.members()}
+    return stream.value()
+
+
+class JSONStreamTest(unittest.TestCase):
+    def test_small_chunks(self):
+        expected = json.loads(DOCUMENT)
+        for chunk_size in range(1, 33):
+            with self.subTest(chunk_size=chunk_size):
+                stream = utils.JSONStream(io.StringIO(DOCUMENT), chunk_size=chunk_size)
+                self.assertEqual(walk(stream), expected)
+
+    def test_numbers_split_after_dot_or_exponent(self):
+        for chunk_size in (1, 2, 3, 4, 8):
+            with self.subTest(chunk_size=chunk_size):
+                stream = utils.JSONStream(io.StringIO("[1.5, 2e10]"), chunk_size=chunk_size)
+                self.assertEqual(list(stream.records()), [1.5, 2e10])
+
+    def test_concatenated_values(self):
+        stream = utils.JSONStream(io.StringIO('1.25\n{"a": 2}\n3e2'), chunk_size=3)
+        self.assertEqual(
+            [walk(stream) for _ in iter(stream.peek, "")], [1.25, {"a": 2}, 300.0]
+        )
+
+
+class SplitTextTest(unittest.TestCase):
+    def test_decimal_point_is_not_a_sentence_end(self):
+        self.assertEqual(
+            utils.split_text("The value 3.14 is pi. ", 12), ["The value", "3.14 is pi. "]
+        )
+
+    def test_cuts_after_sentences(self):
+        self.assertEqual(
+            utils.split_text("First one. Second sentence here.", 20),
+            ["First one.", "Second sentence", "here."],
+        )
+        self.assertEqual(
+            utils.split_text("第一句话。第二句话。第三句话。", 8),
+            ["第一句话。", "第二句话。", "第三句话。"],
+        )
+
+    def test_hard_cut_without_whitespace(self):
+        self.assertEqual(utils.split_text("a" * 10, 4), ["aaaa", "aaaa", "aa"])
+
+
+class JSONFileTest(unittest.TestCase):
+    def test_round_trip(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "state", "sync.json")
+            self.assertEqual(utils.load_json(path, {}), {})
+            utils.save_json_atomic(path, {"b": 1, "a": "中"}, sort_keys=True)
+            utils.save_json_atomic(path, {"b": 2, "a": "中"}, sort_keys=True)
+            self.assertEqual(utils.load_json(path), {"a": "中", "b": 2})
+            self.assertEqual(os.listdir(os.path.dirname(path)), ["sync.json"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from scripts import ROOT, load_script
+
+import zotero_fixtures
+
+try:
+    zotero = load_script("zotero-annotations-to-readwise")
+except SyntaxError:
+    # The script uses Python 3.14 syntax
+    zotero = None
+
+AUTHORS = [{"given": "Johanna", "family": "Rothman"}, {"literal": "ACME"}]
+
+
+@unittest.skipIf(zotero is None, "requires Python 3.14")
+class CollectSqliteHighlightsTest(unittest.TestCase):
+    def setUp(self):
+        with open(os.path.join(ROOT, "example.html"), encoding="utf-8") as file:
+            self.note = file.read()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, "zotero.sqlite")
+        zotero_fixtures.build(self.note, self.path, AUTHORS)
+
+    def note_highlights(self):
+        item = zotero_fixtures.note_item(self.note)
+        item["author"] = AUTHORS
+        highlights = []
+        zotero.collect_highlights(item, [self.note], highlights)
+        return highlights
+
+    def sqlite_highlights(self, collections=(), tags=()):
+        db = sqlite3.connect(self.path)
+        try:
+            selected = zotero.select_sqlite_items(db, 1, list(collections), list(tags))
+            return zotero.collect_sqlite_highlights(db, 1, selected)
+        finally:
+            db.close()
+
+    def test_matches_note_backend(self):
+        expected = self.note_highlights()
+        self.assertEqual(len(expected), 45)
+        self.assertEqual(self.sqlite_highlights(tags=["writing"]), expected)
+
+    def test_whole_library(self):
+        highlights = self.sqlite_highlights()
+        self.assertEqual(highlights[:-1], self.note_highlights())
+        self.assertEqual(highlights[-1]["text"], "other text")
+        self.assertNotIn("gone", [h["text"] for h in highlights])
+
+    def test_collection(self):
+        self.assertEqual(
+            [h["text"] for h in self.sqlite_highlights(collections=["Reading/2024"])],
+            ["other text"],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
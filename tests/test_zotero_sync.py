@@ -0,0 +1,37 @@
+import unittest
+
+from scripts import load_script
+
+try:
+    zotero = load_script("zotero-annotations-to-readwise")
+except SyntaxError:
+    # The script uses Python 3.14 syntax
+    zotero = None
+
+
+@unittest.skipIf(zotero is None, "requires Python 3.14")
+class NumberItemHighlightsTest(unittest.TestCase):
+    def highlights(self, *items):
+        return [
+            {"source_url": f"zotero://select/library/items/{item}", "text": f"{item}{index}"}
+            for item in items
+            for index in range(3)
+        ]
+
+    def test_numbers_do_not_depend_on_other_items(self):
+        full = self.highlights("A", "B")
+        zotero.number_item_highlights(full)
+        changed = self.highlights("B")
+        zotero.number_item_highlights(changed)
+        self.assertEqual(changed, full[3:])
+        self.assertEqual([h["location"] for h in full], [1, 2, 3, 1, 2, 3])
+
+    def test_keeps_page_locations(self):
+        highlights = self.highlights("A")
+        highlights[1]["location"] = 12
+        zotero.number_item_highlights(highlights)
+        self.assertEqual([h.get("location") for h in highlights], [None, 12, None])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""Build a zotero.sqlite holding the subset of the Zotero schema read by
+zotero-annotations-to-readwise.py --sqlite, with the annotations of a Better
+BibTeX note such as example.html, e.g.
+`python tests/zotero_fixtures.py example.html zotero.sqlite`."""
+
+import json
+import sqlite3
+import sys
+import urllib.parse
+
+from bs4 import BeautifulSoup
+
+SCHEMA = """
+CREATE TABLE itemTypes (itemTypeID INTEGER PRIMARY KEY, typeName TEXT);
+CREATE TABLE items (itemID INTEGER PRIMARY KEY, itemTypeID INT, libraryID INT, key TEXT);
+CREATE TABLE fields (fieldID INTEGER PRIMARY KEY, fieldName TEXT);
+CREATE TABLE itemDataValues (valueID INTEGER PRIMARY KEY, value);
+CREATE TABLE itemData (itemID INT, fieldID INT, valueID INT);
+CREATE TABLE creators (
+    creatorID INTEGER PRIMARY KEY, firstName TEXT, lastName TEXT, fieldMode INT
+);
+CREATE TABLE creatorTypes (creatorTypeID INTEGER PRIMARY KEY, creatorType TEXT);
+CREATE TABLE itemCreators (itemID INT, creatorID INT, creatorTypeID INT, orderIndex INT);
+CREATE TABLE itemAttachments (itemID INTEGER PRIMARY KEY, parentItemID INT, contentType TEXT);
+CREATE TABLE itemAnnotations (
+    itemID INTEGER PRIMARY KEY, parentItemID INT, type INT, text TEXT, comment TEXT,
+    color TEXT, pageLabel TEXT, sortIndex TEXT, position TEXT
+);
+CREATE TABLE deletedItems (itemID INTEGER PRIMARY KEY);
+CREATE TABLE collections (
+    collectionID INTEGER PRIMARY KEY, collectionName TEXT, parentCollectionID INT,
+    libraryID INT, key TEXT
+);
+CREATE TABLE collectionItems (collectionID INT, itemID INT, orderIndex INT);
+CREATE TABLE tags (tagID INTEGER PRIMARY KEY, name TEXT);
+CREATE TABLE itemTags (itemID INT, tagID INT, type INT);
+
+INSERT INTO itemTypes VALUES
+    (1, 'book'), (2, 'attachment'), (3, 'annotation'), (4, 'journalArticle');
+INSERT INTO fields VALUES (1, 'title');
+INSERT INTO creatorTypes VALUES (1, 'author'), (2, 'editor');
+"""
+
+# Item and attachment of the note, and a second item in the collection
+# Reading/2024 that must not leak into the note's item
+ITEMS = """
+INSERT INTO items VALUES
+    (1, 1, 1, :item_key), (2, 2, 1, :attachment_key),
+    (3, 4, 1, 'OTHERKEY'), (4, 2, 1, 'OTHERATT');
+INSERT INTO itemDataValues VALUES (1, :title), (2, 'other paper');
+INSERT INTO itemData VALUES (1, 1, 1), (3, 1, 2);
+INSERT INTO itemAttachments VALUES (2, 1, 'application/pdf'), (4, 3, 'application/pdf');
+INSERT INTO collections VALUES (1, 'Reading', NULL, 1, 'C1'), (2, '2024', 1, 1, 'C2');
+INSERT INTO collectionItems VALUES (2, 3, 0);
+INSERT INTO tags VALUES (1, 'writing');
+INSERT INTO itemTags VALUES (1, 1, 0);
+INSERT INTO items VALUES (1000, 3, 1, 'OTHERANN');
+INSERT INTO itemAnnotations VALUES
+    (1000, 4, 1, 'other text', '.h1', '', 'iv', '00000', '{"pageIndex": 3}');
+INSERT INTO items VALUES (999, 3, 1, 'DELETED1');
+INSERT INTO itemAnnotations VALUES
+    (999, 2, 1, 'gone', '', '', '1', '00000', '{"pageIndex": 0}');
+INSERT INTO deletedItems VALUES (999);
+"""
+
+# itemAnnotations.type
+ANNOTATION_HIGHLIGHT = 1
+ANNOTATION_NOTE = 2
+
+
+def note_item(note):
+    """Return the CSL item cited by the note."""
+    soup = BeautifulSoup(note, "html.parser")
+    citation = json.loads(urllib.parse.unquote(soup.div["data-citation-items"]))[0]
+    item = citation["itemData"]
+    item["item-key"] = citation["uris"][0].split("/")[-1]
+    return item
+
+
+def note_annotations(note):
+    """Yield (data, text, comment) for each paragraph of the note, data is
+    None for paragraphs without a highlight."""
+    soup = BeautifulSoup(note, "html.parser")
+    for br in soup.find_all("br"):
+        # Line breaks in comments are dropped by the note backend
+        br.replace_with("\n" if br.find_parent("span", class_="highlight") else "")
+    for p in soup.find_all("p"):
+        spans = p.find_all("span", class_="highlight")
+        data = None
+        if spans:
+            data = json.loads(urllib.parse.unquote(spans[0]["data-annotation"]))
+        text = "…".join(span.extract().get_text().strip().strip("“”") for span in spans)
+        for citation in p.find_all("span", class_="citation"):
+            citation.decompose()
+        yield data, text, p.get_text().strip()
+
+
+def build(note, path, authors=None):
+    """Write the fixture database to `path`. `authors` are CSL names that
+    replace the ones cited by the note."""
+    item = note_item(note)
+    annotations = list(note_annotations(note))
+    attachment_key = next(
+        data["attachmentURI"].split("/")[-1] for data, _, _ in annotations if data
+    )
+
+    db = sqlite3.connect(path)
+    db.executescript(SCHEMA)
+    db.execute("BEGIN")
+    for statement in ITEMS.split(";"):
+        if statement.strip():
+            db.execute(
+                statement,
+                {
+                    "item_key": item["item-key"],
+                    "attachment_key": attachment_key,
+                    "title": item["title"],
+                },
+            )
+    for index, author in enumerate(authors or item["author"]):
+        creator_id = index + 1
+        if "literal" in author:
+            creator = (creator_id, "", author["literal"], 1)
+        else:
+            creator = (creator_id, author["given"], author["family"], 0)
+        db.execute("INSERT INTO creators VALUES (?, ?, ?, ?)", creator)
+        db.execute("INSERT INTO itemCreators VALUES (1, ?, 1, ?)", (creator_id, index))
+
+    for index, (data, text, comment) in enumerate(annotations):
+        item_id = 100 + index
+        sort_index = f"{index:05d}"
+        if data is None:
+            db.execute("INSERT INTO items VALUES (?, 3, 1, ?)", (item_id, f"N{index:07d}"))
+            db.execute(
+                "INSERT INTO itemAnnotations VALUES (?, 2, ?, NULL, ?, '', '', ?, '{}')",
+                (item_id, ANNOTATION_NOTE, comment, sort_index),
+            )
+            continue
+        db.execute(
+            "INSERT INTO items VALUES (?, 3, 1, ?)", (item_id, data["annotationKey"])
+        )
+        db.execute(
+            "INSERT INTO itemAnnotations VALUES (?, 2, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                item_id,
+                ANNOTATION_HIGHLIGHT,
+                text,
+                comment,
+                data["color"],
+                data["pageLabel"],
+                sort_index,
+                json.dumps(data["position"]),
+            ),
+        )
+    db.commit()
+    db.close()
+
+
+if __name__ == "__main__":
+    with open(sys.argv[1], encoding="utf-8") as file:
+        build(file.read(), sys.argv[2])
@@ -1,10 +1,121 @@
+import codecs
+import heapq
+import io
+import itertools
+import mmap
 import os
+import hashlib
+import re
+import sqlite3
 import sys
+import threading
+import zlib
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from http.client import HTTPConnection, HTTPException, HTTPSConnection
+from urllib.parse import urlencode, urlsplit
 from urllib.request import urlopen, Request
 from urllib.error import HTTPError
 import json
 import time
 
+READWISE_URL = os.environ.get("READWISE_URL", "https://readwise.io")
+HIGHLIGHT_STORE = os.environ.get(
+    "READWISE_STORE",
+    os.path.expanduser("~/.local/share/readwise-scripts/highlights.sqlite"),
+)
+# flag, drop or off
+NEAR_DUPLICATES = os.environ.get("READWISE_NEAR_DUPLICATES", "flag")
+# Update highlights uploaded before in place instead of creating them again
+SYNC = os.environ.get("READWISE_SYNC", "") not in ("", "0")
+PATCH_WORKERS = 8
+# Every POST of one run is recorded under the same upload
+CURRENT_UPLOAD = None
+
+BOMS = [
+    (codecs.BOM_UTF8, "utf-8"),
+    (codecs.BOM_UTF16_LE, "utf-16-le"),
+    (codecs.BOM_UTF16_BE, "utf-16-be"),
+]
+
+
+def detect_encoding(data):
+    for bom, encoding in BOMS:
+        if data[: len(bom)] == bom:
+            return encoding, len(bom)
+    return "utf-8", 0
+
+
+def split_lines(data):
+    encoding, start = detect_encoding(data)
+    if encoding != "utf-8":
+        # "\n" is not a single byte in UTF-16, decode the whole buffer instead
+        yield from str(data[start:], encoding).splitlines(keepends=True)
+        return
+
+    with memoryview(data) as view:
+        end = len(view)
+        while start < end:
+            stop = data.find(b"\n", start)
+            stop = end if stop == -1 else stop + 1
+            yield str(view[start:stop], encoding)
+            start = stop
+
+
+def read_stdin_lines():
+    """Stream stdin line by line, as `fileinput` did, with the encoding
+    detected from the BOM."""
+    stdin = sys.stdin.buffer
+    encoding, start = detect_encoding(stdin.peek(3)[:3])
+    stdin.read(start)
+    lines = io.TextIOWrapper(stdin, encoding, newline="")
+    try:
+        yield from lines
+    finally:
+        # Leave stdin open
+        lines.detach()
+
+
+def read_lines(files=None):
+    """Yield lines from files like `fileinput.input`, but memory-map each file
+    and split on bytes, decoding each line once with the encoding detected from
+    the BOM. Stdin is streamed instead."""
+    if not files:
+        files = ["-"]
+    for file in files:
+        if file == "-":
+            yield from read_stdin_lines()
+            continue
+        with open(file, "rb") as handle:
+            if os.fstat(handle.fileno()).st_size == 0:
+                continue
+            with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                yield from split_lines(data)
+
+
+def load_json(path, default=None):
+    """Read a JSON file, or return `default` if it does not exist."""
+    try:
+        with open(path, encoding="utf-8") as handle:
+            return json.load(handle)
+    except FileNotFoundError:
+        return default
+
+
+def save_json_atomic(path, data, **kwargs):
+    """Write `data` to a temporary file next to `path` and rename it over
+    `path`, so an interrupted run never leaves a truncated file. Missing
+    parent directories are created. `kwargs` go to `json.dump`."""
+    path = os.fspath(path)
+    parent = os.path.dirname(path)
+    if parent:
+        os.makedirs(parent, exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as handle:
+        json.dump(data, handle, **kwargs)
+    os.replace(tmp_path, path)
+
 
 def urlopen_retry(req):
     retries = 10
@@ -18,7 +129,11 @@ def urlopen_retry(req):
                 print(
                     f"Rate limited. Retry after: {retry_after} seconds", file=sys.stderr
                 )
-                os.exit(-1)
+                sys.exit(-1)
+            # The same request fails the same way again
+            if 400 <= err.code < 500:
+                print(err.read().decode("utf-8", "replace"), file=sys.stderr)
+                raise
 
             time.sleep(interval)
             retries -= 1
@@ -28,6 +143,242 @@ def urlopen_retry(req):
     return urlopen(req)
 
 
+class RateLimiter:
+    """Spaces out requests so at most `rate` start every `period` seconds,
+    across all threads sharing the limiter."""
+
+    def __init__(self, rate, period=60.0):
+        self.interval = period / rate
+        self.next = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next)
+            self.next = start + self.interval
+        time.sleep(start - now)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.next = max(self.next, time.monotonic() + seconds)
+
+
+class ReadwiseClient:
+    """Keep-alive connections to the Readwise API, one per thread, behind a
+    shared rate limiter. Set READWISE_URL to talk to a local stand-in."""
+
+    def __init__(self, token=None, user_agent=None, limiter=None, retries=5):
+        if token is None:
+            token = os.environ["READWISE_TOKEN"]
+        if user_agent is None:
+            user_agent = os.environ["USER_AGENT"]
+        url = urlsplit(READWISE_URL)
+        self.connection_class = HTTPSConnection if url.scheme == "https" else HTTPConnection
+        self.netloc = url.netloc
+        self.prefix = url.path.rstrip("/")
+        self.headers = {
+            "Authorization": f"Token {token}",
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+            "User-Agent": user_agent,
+        }
+        # Readwise allows 240 requests a minute in general
+        self.limiter = limiter or RateLimiter(240)
+        self.retries = retries
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def connection(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = self.connection_class(self.netloc, timeout=60)
+            with self.lock:
+                self.connections.append(conn)
+        return conn
+
+    def request(self, method, path, params=None, data=None, limiter=None):
+        url = self.prefix + path
+        if params:
+            url += "?" + urlencode(params)
+        body = None if data is None else json.dumps(data).encode("utf-8")
+        limiter = limiter or self.limiter
+        interval = 2
+        for attempt in range(self.retries + 1):
+            limiter.wait()
+            conn = self.connection()
+            try:
+                conn.request(method, url, body=body, headers=self.headers)
+                resp = conn.getresponse()
+                payload = resp.read()
+            except (HTTPException, OSError):
+                conn.close()
+                if attempt == self.retries:
+                    raise
+                time.sleep(interval)
+                interval *= 2
+                continue
+            if resp.status == 429 and attempt < self.retries:
+                retry_after = float(resp.headers.get("Retry-After") or interval)
+                print(f"Rate limited. Retry after: {retry_after} seconds", file=sys.stderr)
+                limiter.pause(retry_after)
+                continue
+            if resp.status >= 500 and attempt < self.retries:
+                time.sleep(interval)
+                interval *= 2
+                continue
+            if resp.status >= 400:
+                reason = payload.decode("utf-8", "replace")
+                raise HTTPError(url, resp.status, reason, resp.headers, None)
+            return json.loads(payload) if payload else None
+
+    def get(self, path, params=None, limiter=None):
+        return self.request("GET", path, params=params, limiter=limiter)
+
+    def close(self):
+        for conn in self.connections:
+            conn.close()
+
+
+# The list and export endpoints are limited to 20 requests a minute
+EXPORT_LIMITER = RateLimiter(20)
+
+
+def fetch_export(client, updated_after=None, ids=None):
+    """Yield the books of the Readwise export, following page cursors. Only
+    books with highlights updated after `updated_after` are returned, and with
+    `ids` only those books."""
+    params = {}
+    if updated_after:
+        params["updatedAfter"] = updated_after
+    if ids:
+        params["ids"] = ",".join(str(book_id) for book_id in ids)
+    while True:
+        page = client.get("/api/v2/export/", params, limiter=EXPORT_LIMITER)
+        yield from page["results"]
+        cursor = page.get("nextPageCursor")
+        if not cursor:
+            return
+        params["pageCursor"] = cursor
+
+
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+NUMBER_TAIL = re.compile(r"[0-9.eE+-]*")
+WHITESPACE_RUN = re.compile(r"\s+")
+
+
+class JSONStream:
+    """Incremental JSON reader over a text handle.
+
+    Containers can be walked with `items` and `members` while leaf values are
+    decoded with `value`, so only the buffer and the current value are kept in
+    memory.
+    """
+
+    def __init__(self, handle, chunk_size=1 << 16):
+        self.handle = handle
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.pending = False
+
+    def fill(self):
+        if self.eof:
+            return False
+        chunk = self.handle.read(self.chunk_size)
+        if chunk == "":
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos :] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ""
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"expect {char!r} but got {found!r}")
+        self.pos += 1
+
+    def value(self):
+        self.pending = False
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if self.fill():
+                    continue
+                raise
+            # A number may continue in the next chunk, even past a partial
+            # fraction or exponent such as `1.` or `2e` that did not decode
+            if (
+                isinstance(value, (int, float))
+                and not isinstance(value, bool)
+                and NUMBER_TAIL.match(self.buffer, end).end() == len(self.buffer)
+                and self.fill()
+            ):
+                continue
+            self.pos = end
+            return value
+
+    def items(self):
+        self.pending = False
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            separator = self.peek()
+            self.pos += 1
+            if separator == "]":
+                return
+            if separator != ",":
+                raise ValueError(f"unexpected {separator!r} in array")
+
+    def members(self):
+        """Yield the keys of an object. The caller reads the value with
+        `value`, `items` or `members`, otherwise it is skipped."""
+        self.pending = False
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(":")
+            self.pending = True
+            yield key
+            if self.pending:
+                self.value()
+            separator = self.peek()
+            self.pos += 1
+            if separator == "}":
+                return
+            if separator != ",":
+                raise ValueError(f"unexpected {separator!r} in object")
+
+    def records(self):
+        """Yield the items of a top-level array, or each value of a stream of
+        concatenated values such as NDJSON."""
+        if self.peek() == "[":
+            yield from self.items()
+            return
+        while self.peek() != "":
+            yield self.value()
+
+
 def is_concatenating(entry):
     return (
         "note" in entry
@@ -91,26 +442,695 @@ def add_tags(highlights, ids, token, user_agent):
                 urlopen_retry(req)
 
 
-def auto_number_highlights(highlights):
+STORE_SCHEMA = """
+PRAGMA journal_mode = WAL;
+CREATE TABLE IF NOT EXISTS highlights (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL UNIQUE,
+    text TEXT,
+    note TEXT,
+    tags TEXT,
+    title TEXT,
+    author TEXT,
+    source_type TEXT,
+    category TEXT,
+    source_url TEXT,
+    highlight_url TEXT,
+    location TEXT,
+    location_type TEXT,
+    highlighted_at TEXT,
+    stored_at TEXT
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS highlights_fts USING fts5(
+    text, note, tags, author, title, content='highlights', content_rowid='id'
+);
+CREATE TRIGGER IF NOT EXISTS highlights_ai AFTER INSERT ON highlights BEGIN
+    INSERT INTO highlights_fts (rowid, text, note, tags, author, title)
+    VALUES (new.id, new.text, new.note, new.tags, new.author, new.title);
+END;
+CREATE TRIGGER IF NOT EXISTS highlights_ad AFTER DELETE ON highlights BEGIN
+    INSERT INTO highlights_fts (highlights_fts, rowid, text, note, tags, author, title)
+    VALUES ('delete', old.id, old.text, old.note, old.tags, old.author, old.title);
+END;
+CREATE TRIGGER IF NOT EXISTS highlights_au AFTER UPDATE ON highlights BEGIN
+    INSERT INTO highlights_fts (highlights_fts, rowid, text, note, tags, author, title)
+    VALUES ('delete', old.id, old.text, old.note, old.tags, old.author, old.title);
+    INSERT INTO highlights_fts (rowid, text, note, tags, author, title)
+    VALUES (new.id, new.text, new.note, new.tags, new.author, new.title);
+END;
+CREATE TABLE IF NOT EXISTS sketches (
+    key TEXT PRIMARY KEY,
+    sketch BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS readwise_ids (
+    key TEXT PRIMARY KEY,
+    id INTEGER NOT NULL,
+    digest TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS readwise_ids_id ON readwise_ids (id);
+CREATE TABLE IF NOT EXISTS uploads (
+    id INTEGER PRIMARY KEY,
+    started_at TEXT NOT NULL,
+    command TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS upload_highlights (
+    upload_id INTEGER NOT NULL,
+    highlight_id INTEGER NOT NULL,
+    preexisting INTEGER NOT NULL DEFAULT 0,
+    deleted INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (upload_id, highlight_id)
+);
+CREATE TABLE IF NOT EXISTS minhashes (
+    book TEXT NOT NULL,
+    hash INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    UNIQUE (book, hash, key)
+);
+"""
+
+SHINGLE_SIZE = 5
+SKETCH_SIZE = 32
+# Only the smallest hashes go into the lookup index. Two passages share
+# their minimum shingle hash with a probability equal to their Jaccard
+# similarity, so near-duplicates nearly always share one of these
+INDEXED_HASHES = 8
+NEAR_DUPLICATE_THRESHOLD = 0.8
+LOCATION_SUFFIX = re.compile(
+    r"\s*[(（](?:loc(?:ation)?|page|p\.?)\s*[\d\-–]+[)）]\s*$", re.IGNORECASE
+)
+NON_WORD = re.compile(r"[\W_]+")
+
+STORE_COLUMNS = [
+    "text",
+    "note",
+    "title",
+    "author",
+    "source_type",
+    "category",
+    "source_url",
+    "highlight_url",
+    "location",
+    "location_type",
+    "highlighted_at",
+]
+
+STORE_UPSERT = f"""
+INSERT INTO highlights (key, tags, stored_at, {", ".join(STORE_COLUMNS)})
+VALUES (?, ?, ?, {", ".join("?" for _ in STORE_COLUMNS)})
+ON CONFLICT (key) DO UPDATE SET
+    tags = excluded.tags,
+    stored_at = excluded.stored_at,
+    {", ".join(f"{column} = excluded.{column}" for column in STORE_COLUMNS)}
+"""
+
+
+def open_store(path=None):
+    path = path or HIGHLIGHT_STORE
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.executescript(STORE_SCHEMA)
+    return conn
+
+
+def note_tags(note):
+    if not note or not note.startswith("."):
+        return ""
+    return " ".join(tag[1:] for tag in note.splitlines()[0].split() if tag.startswith("."))
+
+
+def store_key(highlight):
+    raw = "|".join(
+        str(highlight.get(field) or "") for field in ("title", "author", "text", "location")
+    )
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def book_key(highlight):
+    """Titles differ between stores mostly in case, punctuation and
+    subtitles."""
+    title = (highlight.get("title") or "").casefold()
+    title = re.split(r"[:：]", title, maxsplit=1)[0]
+    return NON_WORD.sub("", title)
+
+
+def passage_sketch(text):
+    """Bottom-k MinHash sketch of the character shingles of a passage, with
+    case, punctuation, whitespace and location suffixes removed. Passages
+    too short to shingle have none."""
+    text = NON_WORD.sub("", LOCATION_SUFFIX.sub("", text or "").casefold())
+    if len(text) < SHINGLE_SIZE:
+        return []
+    hashes = {
+        zlib.crc32(text[i : i + SHINGLE_SIZE].encode("utf-8"))
+        for i in range(len(text) - SHINGLE_SIZE + 1)
+    }
+    return heapq.nsmallest(SKETCH_SIZE, hashes)
+
+
+def sketch_similarity(a, b):
+    """Estimate the Jaccard similarity of two passages from their sketches."""
+    both = set(a) & set(b)
+    union = heapq.nsmallest(SKETCH_SIZE, set(a) | set(b))
+    return sum(h in both for h in union) / len(union)
+
+
+def store_highlights(highlights, conn=None):
+    """Upsert highlights into the local store in a single transaction.
+    Highlights are keyed by title, author, text and location."""
+    owned = conn is None
+    if owned:
+        conn = open_store()
+    stored_at = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    try:
+        with conn:
+            for batch in itertools.batched(highlights, 1000):
+                keys = [store_key(h) for h in batch]
+                conn.executemany(
+                    STORE_UPSERT,
+                    (
+                        (key, note_tags(h.get("note")), stored_at)
+                        + tuple(h.get(column) for column in STORE_COLUMNS)
+                        for key, h in zip(keys, batch)
+                    ),
+                )
+                index_sketches(conn, zip(keys, batch))
+    finally:
+        if owned:
+            conn.close()
+
+
+def index_sketches(conn, keyed_highlights):
+    keyed_highlights = list(keyed_highlights)
+    known = set()
+    for batch in itertools.batched(keyed_highlights, 500):
+        known.update(
+            key
+            for (key,) in conn.execute(
+                "SELECT key FROM sketches"
+                f" WHERE key IN ({', '.join('?' for _ in batch)})",
+                [key for key, _ in batch],
+            )
+        )
+    sketches = []
+    minhashes = []
+    for key, highlight in keyed_highlights:
+        if key in known:
+            continue
+        sketch = passage_sketch(highlight.get("text"))
+        if not sketch:
+            continue
+        book = book_key(highlight)
+        sketches.append((key, array("I", sketch).tobytes()))
+        minhashes.extend((book, h, key) for h in sketch[:INDEXED_HASHES])
+    conn.executemany("INSERT OR IGNORE INTO sketches VALUES (?, ?)", sketches)
+    conn.executemany("INSERT OR IGNORE INTO minhashes VALUES (?, ?, ?)", minhashes)
+
+
+def reindex_sketches(conn):
+    """Sketch stored highlights that have no sketch yet."""
+    rows = conn.execute(
+        "SELECT key, title, text FROM highlights"
+        " WHERE key NOT IN (SELECT key FROM sketches)"
+    )
+    missing = [(key, {"title": title, "text": text}) for key, title, text in rows]
+    with conn:
+        index_sketches(conn, missing)
+
+
+def find_near_duplicates(conn, highlights):
+    """Map the index of each highlight that nearly duplicates one in the store,
+    or an earlier unmatched one in `highlights`, from the same book to
+    (similarity, text of the best match). Highlights already in the store
+    and the pieces of split highlights are never matched."""
+    matches = {}
+    seen = {}
+    for index, highlight in enumerate(highlights):
+        # Dropping a piece would break its concatenation
+        if is_split_piece(highlight):
+            continue
+        sketch = passage_sketch(highlight.get("text"))
+        if not sketch:
+            continue
+        book = book_key(highlight)
+        key = store_key(highlight)
+        indexed = sketch[:INDEXED_HASHES]
+        rows = conn.execute(
+            "SELECT sketches.key, sketches.sketch, highlights.text FROM sketches"
+            " JOIN highlights ON highlights.key = sketches.key"
+            " WHERE sketches.key IN (SELECT key FROM minhashes"
+            f" WHERE book = ? AND hash IN ({', '.join('?' for _ in indexed)}))",
+            (book, *indexed),
+        )
+        candidates = [(k, array("I", blob).tolist(), text) for k, blob, text in rows]
+        for h in indexed:
+            candidates.extend(seen.get((book, h), []))
+
+        # The same highlight imported again is left to Readwise
+        if any(other_key == key for other_key, _, _ in candidates):
+            continue
+        best = None
+        for other_key, other_sketch, other_text in candidates:
+            similarity = sketch_similarity(sketch, other_sketch)
+            if similarity >= NEAR_DUPLICATE_THRESHOLD and (
+                best is None or similarity > best[0]
+            ):
+                best = (similarity, other_text)
+        if best is not None:
+            matches[index] = best
+            continue
+        for h in indexed:
+            seen.setdefault((book, h), []).append((key, sketch, highlight.get("text")))
+    return matches
+
+
+def filter_near_duplicates(highlights, mode=None):
+    """Report highlights that nearly duplicate one already uploaded for the
+    same book, from any source, and leave them out with mode "drop"."""
+    mode = mode or NEAR_DUPLICATES
+    if mode == "off":
+        return highlights
+    conn = open_store()
+    try:
+        matches = find_near_duplicates(conn, highlights)
+    finally:
+        conn.close()
+    kept = []
+    for index, highlight in enumerate(highlights):
+        if index in matches:
+            similarity, other_text = matches[index]
+            action = "Dropping" if mode == "drop" else "Found"
+            print(
+                f"{action} near-duplicate ({similarity:.0%}) in {highlight.get('title')}:\n"
+                f"  {highlight.get('text')!r}\n  {other_text!r}",
+                file=sys.stderr,
+            )
+            if mode == "drop":
+                continue
+        kept.append(highlight)
+    return kept
+
+
+# Field limits of the Readwise highlight API
+HIGHLIGHT_LIMITS = {
+    "text": 8191,
+    "title": 511,
+    "author": 1024,
+    "note": 8191,
+    "source_url": 2047,
+    "image_url": 2047,
+    "highlight_url": 4095,
+}
+CATEGORIES = {"books", "articles", "tweets", "podcasts"}
+LOCATION_TYPES = {"page", "order", "time_offset"}
+# json-to-markdown joins .c1 up to .c9 back together
+MAX_PIECES = 9
+SPLIT_PIECE = re.compile(r"\.c[1-9]\b")
+# Latin punctuation only ends a sentence before whitespace, so "3.14" stays
+# whole, while CJK full-width punctuation needs no space after it
+SENTENCE_END = re.compile(r"(?<=[.!?…])\s+|(?<=[。！？])\s*|\n")
+
+
+def coerce_location(value):
+    if isinstance(value, bool):
+        raise ValueError(f"bad location {value!r}")
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, str) and value.strip().isdigit():
+        return int(value)
+    raise ValueError(f"bad location {value!r}")
+
+
+def coerce_highlighted_at(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        value = datetime.fromtimestamp(value, timezone.utc)
+    elif isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value)
+        except ValueError:
+            raise ValueError(f"bad highlighted_at {value!r}") from None
+    elif not isinstance(value, datetime):
+        raise ValueError(f"bad highlighted_at {value!r}")
+    aware = value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    if not (
+        datetime(1970, 1, 1, tzinfo=timezone.utc)
+        <= aware
+        <= datetime.now(timezone.utc) + timedelta(days=1)
+    ):
+        raise ValueError(f"highlighted_at {value.isoformat()} out of range")
+    return value.isoformat()
+
+
+def check_highlight(highlight):
+    """Coerce the fields of a highlight in place and return what is still
+    wrong with it."""
+    problems = []
+    for field in HIGHLIGHT_LIMITS.keys() | {"source_type", "category", "location_type"}:
+        if highlight.get(field) is None:
+            highlight.pop(field, None)
+        elif not isinstance(highlight[field], str):
+            highlight[field] = str(highlight[field])
+
+    if not highlight.get("text", "").strip():
+        problems.append("missing text")
+    if not highlight.get("title", "").strip():
+        problems.append("missing title")
+    for field, limit in HIGHLIGHT_LIMITS.items():
+        # Long texts are split instead
+        if field != "text" and len(highlight.get(field, "")) > limit:
+            problems.append(f"{field} longer than {limit} characters")
+
+    if "category" in highlight:
+        highlight["category"] = highlight["category"].lower()
+        if highlight["category"] not in CATEGORIES:
+            problems.append(f"bad category {highlight['category']!r}")
+    if "source_type" in highlight and not 3 <= len(highlight["source_type"]) <= 64:
+        problems.append(f"source_type {highlight['source_type']!r} not 3 to 64 characters")
+    if highlight.get("location_type", "order") not in LOCATION_TYPES:
+        problems.append(f"bad location_type {highlight['location_type']!r}")
+
+    for field, coerce in (
+        ("location", coerce_location),
+        ("highlighted_at", coerce_highlighted_at),
+    ):
+        if highlight.get(field) is None:
+            highlight.pop(field, None)
+            continue
+        try:
+            highlight[field] = coerce(highlight[field])
+        except ValueError as err:
+            problems.append(str(err))
+    return problems
+
+
+def split_text(text, limit):
+    """Cut text into pieces of at most `limit` characters, at the last
+    sentence end or whitespace that keeps the piece at least half full."""
+    pieces = []
+    while len(text) > limit:
+        cut = None
+        for pattern in (SENTENCE_END, WHITESPACE_RUN):
+            ends = [m.end() for m in pattern.finditer(text, limit // 2, limit + 1)]
+            if ends:
+                cut = ends[-1]
+                break
+        if cut is None or cut > limit:
+            cut = limit
+        pieces.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    pieces.append(text)
+    return pieces
+
+
+def is_split_piece(highlight):
+    return SPLIT_PIECE.match(highlight.get("note") or "") is not None
+
+
+def split_highlight(highlight):
+    """Split a highlight whose text is too long into .c1, .c2 ... pieces. The
+    note stays on the first piece."""
+    pieces = split_text(highlight["text"], HIGHLIGHT_LIMITS["text"])
+    if len(pieces) == 1:
+        return [highlight]
+    if len(pieces) > MAX_PIECES:
+        raise ValueError(f"text too long even for {MAX_PIECES} pieces")
+    if is_concatenating(highlight):
+        raise ValueError("text too long for a .c piece")
+    note = highlight.get("note", "")
+    if note.startswith("."):
+        first_note = f".c1 {note}"
+    else:
+        first_note = f".c1\n{note}".rstrip()
+    result = []
+    for number, piece in enumerate(pieces, 1):
+        entry = dict(highlight)
+        entry["text"] = piece
+        entry["note"] = first_note if number == 1 else f".c{number}"
+        result.append(entry)
+    return result
+
+
+def validate_highlights(highlights):
+    """Make highlights acceptable to the Readwise API before anything is sent:
+    coerce types, split over-long texts and raise all remaining problems in
+    one go."""
+    result = []
+    problems = []
+    for index, highlight in enumerate(highlights):
+        label = f"#{index + 1} {str(highlight.get('text', ''))[:40]!r}"
+        errors = check_highlight(highlight)
+        if not errors:
+            try:
+                result.extend(split_highlight(highlight))
+            except ValueError as err:
+                errors.append(str(err))
+        problems.extend(f"{label}: {error}" for error in errors)
+    if problems:
+        raise ValueError(
+            f"{len(problems)} problems, not uploading:\n" + "\n".join(problems)
+        )
+    return result
+
+
+def auto_number_highlights(highlights, start=0):
     if any("location" in item for item in highlights):
-        return
+        return False
 
     for index, highlight in enumerate(highlights):
         highlight["location_type"] = "order"
-        highlight["location"] = index + 1
+        highlight["location"] = start + index + 1
+    return True
+
+
+def readwise_key(highlight):
+    """Stable key of a highlight across parses: its book and the start of its
+    text, so fixing a note or extending a concatenation keeps it. The location
+    only counts when it comes from the source, a position from
+    auto_number_highlights shifts whenever a highlight is added before it."""
+    prefix = NON_WORD.sub("", str(highlight.get("text") or "").casefold())[:32]
+    fields = ["title", "author"]
+    if highlight.get("location_type", "order") != "order":
+        fields.append("location")
+    raw = "|".join(str(highlight.get(field) or "") for field in fields)
+    return hashlib.sha1(f"{raw}|{prefix}".encode("utf-8")).hexdigest()
+
+
+def highlight_patch(highlight):
+    """The fields of a highlight Readwise lets us update."""
+    patch = {"text": highlight["text"], "note": highlight.get("note", "")}
+    if "location" in highlight:
+        patch["location"] = highlight["location"]
+    if "highlight_url" in highlight:
+        patch["url"] = highlight["highlight_url"]
+    return patch
+
+
+def readwise_digest(highlight):
+    raw = json.dumps(highlight_patch(highlight), sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def lookup_readwise_ids(conn, keys):
+    known = {}
+    for batch in itertools.batched(keys, 500):
+        known.update(
+            (key, (id, digest))
+            for key, id, digest in conn.execute(
+                "SELECT key, id, digest FROM readwise_ids"
+                f" WHERE key IN ({', '.join('?' for _ in batch)})",
+                batch,
+            )
+        )
+    return known
+
+
+def record_readwise_ids(highlights, items):
+    """Store the IDs Readwise returned for uploaded highlights. Each returned
+    book lists the IDs of its highlights in the order they were sent."""
+    books = {}
+    for highlight in highlights:
+        book = (highlight.get("title"), highlight.get("author") or "")
+        books.setdefault(book, []).append(highlight)
+    rows = []
+    for item in items:
+        book = (item.get("title"), item.get("author") or "")
+        sent = books.get(book, [])
+        ids = item.get("modified_highlights", [])
+        if len(sent) != len(ids):
+            print(
+                f"Cannot match {len(ids)} IDs to {len(sent)} highlights of {book[0]}",
+                file=sys.stderr,
+            )
+            continue
+        rows.extend(
+            (readwise_key(highlight), id, readwise_digest(highlight))
+            for highlight, id in zip(sent, ids)
+        )
+    conn = open_store()
+    try:
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO readwise_ids VALUES (?, ?, ?)", rows)
+    finally:
+        conn.close()
+
+
+def begin_upload():
+    """Start recording this run's upload, before its first POST, so every
+    highlight it creates is created after `started_at`."""
+    global CURRENT_UPLOAD
+    if CURRENT_UPLOAD is None:
+        conn = open_store()
+        try:
+            with conn:
+                CURRENT_UPLOAD = conn.execute(
+                    "INSERT INTO uploads (started_at, command) VALUES (?, ?)",
+                    (
+                        time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                        " ".join(sys.argv),
+                    ),
+                ).lastrowid
+        finally:
+            conn.close()
+    return CURRENT_UPLOAD
+
+
+def record_upload(items):
+    """Record the IDs Readwise returned under this run's upload, so the run
+    can be rolled back. IDs already in the ID map were only updated by the
+    upload and are marked as preexisting. Readwise also merges a highlight
+    into an existing one it matches, which rollback-upload.py tells apart by
+    its creation time."""
+    upload_id = begin_upload()
+    ids = [id for item in items for id in item.get("modified_highlights", [])]
+    conn = open_store()
+    try:
+        with conn:
+            preexisting = set()
+            for batch in itertools.batched(ids, 500):
+                preexisting.update(
+                    id
+                    for (id,) in conn.execute(
+                        "SELECT id FROM readwise_ids"
+                        f" WHERE id IN ({', '.join('?' for _ in batch)})",
+                        batch,
+                    )
+                )
+            conn.executemany(
+                "INSERT OR IGNORE INTO upload_highlights"
+                " (upload_id, highlight_id, preexisting) VALUES (?, ?, ?)",
+                ((upload_id, id, id in preexisting) for id in ids),
+            )
+    finally:
+        conn.close()
+
+
+def patch_highlight(client, id, highlight):
+    try:
+        client.request("PATCH", f"/api/v2/highlights/{id}/", data=highlight_patch(highlight))
+    except HTTPError as err:
+        # Deleted on Readwise since, create it again
+        if err.code == 404:
+            return False
+        raise
+    return True
+
+
+def sync_highlights(highlights, token=None, user_agent=None):
+    """PATCH highlights uploaded before whose content changed, skip the
+    unchanged ones, and return those Readwise has not seen yet."""
+    keys = [readwise_key(highlight) for highlight in highlights]
+    conn = open_store()
+    try:
+        known = lookup_readwise_ids(conn, keys)
+    finally:
+        conn.close()
+
+    new = []
+    changed = []
+    unchanged = 0
+    for key, highlight in zip(keys, highlights):
+        if key not in known:
+            new.append(highlight)
+        elif known[key][1] == readwise_digest(highlight):
+            unchanged += 1
+        else:
+            changed.append((key, known[key][0], highlight))
+    print(f"Updating {len(changed)} highlights, {unchanged} unchanged...")
+    if not changed:
+        return new
+
+    client = ReadwiseClient(token, user_agent)
+    try:
+        with ThreadPoolExecutor(max_workers=PATCH_WORKERS) as executor:
+            patched = list(
+                executor.map(
+                    lambda change: patch_highlight(client, change[1], change[2]),
+                    changed,
+                )
+            )
+    finally:
+        client.close()
+
+    updates = []
+    for (key, id, highlight), ok in zip(changed, patched):
+        if ok:
+            updates.append((readwise_digest(highlight), key))
+        else:
+            new.append(highlight)
+    conn = open_store()
+    try:
+        with conn:
+            conn.executemany("UPDATE readwise_ids SET digest = ? WHERE key = ?", updates)
+    finally:
+        conn.close()
+    return new
+
+
+def upload_highlights(highlights, token=None, user_agent=None):
+    if SYNC:
+        highlights = sync_highlights(highlights, token, user_agent)
+    highlights = filter_near_duplicates(highlights)
+    if highlights:
+        post_highlights(highlights, token, user_agent)
 
 
 def create_highlights(highlights, token=None, user_agent=None):
+    highlights = validate_highlights(squash_concatenating_highlights(highlights))
+    auto_number_highlights(highlights)
+    upload_highlights(highlights, token, user_agent)
+
+
+def create_highlights_in_batches(
+    highlights, batch_size=1000, token=None, user_agent=None
+):
+    """Upload an iterable of highlights in batches of `batch_size`, so the
+    input is never materialized as a whole.
+
+    Whether to auto-number is decided by the first batch, and numbering
+    continues across batches."""
+    numbering = None
+    start = 0
+    for batch in itertools.batched(
+        squash_concatenating_highlights(highlights), batch_size
+    ):
+        batch = validate_highlights(batch)
+        if numbering is None:
+            numbering = auto_number_highlights(batch)
+        elif numbering:
+            auto_number_highlights(batch, start)
+        start += len(batch)
+        upload_highlights(batch, token, user_agent)
+
+
+def post_highlights(highlights, token=None, user_agent=None):
     if token is None:
         token = os.environ["READWISE_TOKEN"]
     if user_agent is None:
         user_agent = os.environ["USER_AGENT"]
 
-    highlights = list(squash_concatenating_highlights(highlights))
-    auto_number_highlights(highlights)
-
     req = Request(
-        "https://readwise.io/api/v2/highlights/",
+        f"{READWISE_URL}/api/v2/highlights/",
         headers={
             "Authorization": f"Token {token}",
             "Content-Type": "application/json",
@@ -120,10 +1140,14 @@ def create_highlights(highlights, token=None, user_agent=None):
         data=json.dumps({"highlights": highlights}).encode("utf-8"),
         method="POST",
     )
+    begin_upload()
     print("Creating highlights...")
     resp = urlopen_retry(req)
 
     items = json.loads(resp.read().decode("utf-8"))
+    store_highlights(highlights)
+    record_upload(items)
+    record_readwise_ids(highlights, items)
     if len(items) == 1 and len(items[0]["modified_highlights"]) == len(highlights):
         # add_tags(highlights, items[0]["modified_highlights"], token, user_agent)
         pass
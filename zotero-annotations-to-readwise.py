@@ -2,43 +2,387 @@
 
 # ruff: noqa: E501
 
+import argparse
+import functools
+import hashlib
+import itertools
+import os
 import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
 import utils
 from titlecase import titlecase
 import json
 import urllib.parse
-from urllib.request import urlopen, Request
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from http.client import HTTPConnection
 from bs4 import BeautifulSoup
 from pathlib import Path
 from datetime import datetime
 
 UPLOADS_SITE = "https://blog.iany.me"
 ZOTERO_STORAGE_DIR = Path.home() / "Zotero" / "storage"
+ZOTERO_SQLITE = Path.home() / "Zotero" / "zotero.sqlite"
+BBT_HOST = "127.0.0.1"
+# Point at zotero-bbt-fixtures.py serve to run without Zotero
+BBT_PORT = int(os.environ.get("BBT_PORT", "23119"))
+NOTES_BATCH_SIZE = 100
 UPLOADS_DIR = Path("uploads") / datetime.now().strftime("%Y%m") / "zotero"
+UPLOADS_MANIFEST = UPLOADS_DIR / ".manifest.json"
+IMAGE_EXTENSIONS = ["jpg", "jpeg", "png", "gif", "webp"]
+# Set IMAGE_FORMAT to "webp" or "jpeg" to transcode annotation images, see
+# --image-format.
+IMAGE_FORMAT = None
+IMAGE_MAX_WIDTH = 1600
+IMAGE_QUALITY = 80
+IMAGE_CACHE_DIR = Path.home() / ".cache" / "readwise-scripts" / "zotero-images"
+TRANSCODE_EXTENSIONS = {"webp": "webp", "jpeg": "jpg"}
+SYNC_STATE = Path.home() / ".local" / "state" / "readwise-scripts" / "zotero.json"
+LOCAL_API_BATCH_SIZE = 50
+
+# Attachment keys of images referenced by the converted notes, copied in bulk
+# by copy_images once all notes are converted.
+PENDING_IMAGES = set()
+
+
+@functools.cache
+def image_index():
+    rank = {ext: index for index, ext in enumerate(IMAGE_EXTENSIONS)}
+    index = {}
+    for path in ZOTERO_STORAGE_DIR.glob("*/image.*"):
+        ext = path.suffix[1:]
+        if ext not in rank:
+            continue
+        current = index.get(path.parent.name)
+        if current is None or rank[ext] < rank[current.suffix[1:]]:
+            index[path.parent.name] = path
+    return index
 
 
 def get_image_path(attachment_key):
-    dir = ZOTERO_STORAGE_DIR / attachment_key
-    for ext in ["jpg", "jpeg", "png", "gif", "webp"]:
-        try_path = dir / f"image.{ext}"
-        if try_path.exists():
-            return try_path
+    return image_index().get(attachment_key)
+
+
+def file_sha256(path):
+    with open(path, "rb") as handle:
+        return hashlib.file_digest(handle, "sha256").hexdigest()
+
+
+def upload_name(image_path):
+    if IMAGE_FORMAT is None or image_path.suffix == ".gif":
+        return image_path.name
+    return f"image.{TRANSCODE_EXTENSIONS[IMAGE_FORMAT]}"
+
+
+def image_variant(image_path):
+    if upload_name(image_path) == image_path.name:
+        return None
+    return f"{IMAGE_FORMAT}-{IMAGE_MAX_WIDTH}"
+
+
+def transcoded_path(record):
+    ext = record["name"].rsplit(".", 1)[1]
+    return IMAGE_CACHE_DIR / f"{record['sha256']}-{record['variant']}.{ext}"
+
+
+def transcode_image(source, target, image_format, max_width):
+    from PIL import Image
+
+    with Image.open(source) as image:
+        image.thumbnail((max_width, image.height))
+        if image_format == "jpeg" and image.mode not in ["RGB", "L"]:
+            image = image.convert("RGB")
+        tmp_path = target.with_name(target.name + ".tmp")
+        image.save(tmp_path, format=image_format.upper(), quality=IMAGE_QUALITY)
+    os.replace(tmp_path, target)
 
 
-def copy_image(attachment_key):
+def check_image(attachment_key, record):
+    """Return the manifest record for the attachment image, and the source
+    path if it must be written into UPLOADS_DIR."""
     image_path = get_image_path(attachment_key)
-    if image_path:
-        # copy the image directory into UPLOADS_DIR
-        shutil.copytree(
-            image_path.parent, UPLOADS_DIR / image_path.parent.name, dirs_exist_ok=True
+    name = upload_name(image_path)
+    variant = image_variant(image_path)
+    target = UPLOADS_DIR / attachment_key / name
+    stat = image_path.stat()
+    up_to_date = (
+        record is not None
+        and record["name"] == name
+        and record.get("variant") == variant
+        and target.exists()
+    )
+    if (
+        up_to_date
+        and record["size"] == stat.st_size
+        and record["mtime_ns"] == stat.st_mtime_ns
+    ):
+        return record, None
+
+    new_record = {
+        "name": name,
+        "variant": variant,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha256": file_sha256(image_path),
+    }
+    if up_to_date and record["sha256"] == new_record["sha256"]:
+        return new_record, None
+    return new_record, image_path
+
+
+def write_image(attachment_key, record, image_path):
+    target = UPLOADS_DIR / attachment_key / record["name"]
+    target.parent.mkdir(parents=True, exist_ok=True)
+    if record["variant"] is None:
+        shutil.copy2(image_path, target)
+    else:
+        shutil.copyfile(transcoded_path(record), target)
+
+
+def copy_images(attachment_keys, jobs):
+    manifest = utils.load_json(UPLOADS_MANIFEST, {})
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        checked = list(
+            executor.map(
+                lambda key: check_image(key, manifest.get(key)), attachment_keys
+            )
         )
+    pending = [
+        (key, record, image_path)
+        for key, (record, image_path) in zip(attachment_keys, checked)
+        if image_path is not None
+    ]
+
+    # Transcoded images are cached by source hash, so only new content is
+    # converted.
+    transcodes = {}
+    for _, record, image_path in pending:
+        if record["variant"] is not None:
+            cached = transcoded_path(record)
+            if not cached.exists():
+                transcodes[cached] = image_path
+    if transcodes:
+        IMAGE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        with ProcessPoolExecutor() as executor:
+            list(
+                executor.map(
+                    transcode_image,
+                    transcodes.values(),
+                    transcodes.keys(),
+                    itertools.repeat(IMAGE_FORMAT),
+                    itertools.repeat(IMAGE_MAX_WIDTH),
+                )
+            )
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        list(executor.map(lambda args: write_image(*args), pending))
+
+    for key, (record, _) in zip(attachment_keys, checked):
+        manifest[key] = record
+    utils.save_json_atomic(UPLOADS_MANIFEST, manifest, indent=2, sort_keys=True)
 
 
-def get_items():
-    with urlopen(
-        "http://127.0.0.1:23119/better-bibtex/cayw?&format=translate&translator=csljson"
-    ) as resp:
-        return json.loads(resp.read().decode("utf-8"))
+def connect_bbt():
+    return HTTPConnection(BBT_HOST, BBT_PORT)
+
+
+def get_json(conn, path):
+    conn.request("GET", path)
+    resp = conn.getresponse()
+    body = resp.read().decode("utf-8")
+    if resp.status != 200:
+        raise RuntimeError(f"GET {path} failed: {resp.status} {body}")
+    return json.loads(body)
+
+
+def get_items(conn):
+    return get_json(conn, "/better-bibtex/cayw?&format=translate&translator=csljson")
+
+
+def library_export_path(library_id):
+    return f"/better-bibtex/export/library?/{library_id}/library.csljson"
+
+
+def collection_export_path(library_id, collection):
+    path = urllib.parse.quote(collection.strip("/"))
+    return f"/better-bibtex/export/collection?/{library_id}/{path}.csljson"
+
+
+def search_tag(conn, tag):
+    found = json_rpc(conn, "item.search", [[["tag", "is", tag]]])
+    return {item.get("citekey") or item.get("citationKey") for item in found}
+
+
+def json_rpc(conn, method, params):
+    conn.request(
+        "POST",
+        "/better-bibtex/json-rpc",
+        body=json.dumps({"jsonrpc": "2.0", "method": method, "params": params}).encode(
+            "utf-8"
+        ),
+        headers={"Content-Type": "application/json", "Accept": "application/json"},
+    )
+    resp = conn.getresponse()
+    body = json.loads(resp.read().decode("utf-8"))
+    if "error" in body:
+        raise RuntimeError(f"{method} failed: {body['error']}")
+    return body["result"]
+
+
+class ConnectionPool:
+    """One keep-alive Better BibTeX connection per worker thread."""
+
+    def __init__(self):
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def get(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = connect_bbt()
+            with self.lock:
+                self.connections.append(conn)
+        return conn
+
+    def close(self):
+        for conn in self.connections:
+            conn.close()
+
+
+def select_items(pool, executor, library, collections, tags, library_id):
+    paths = [collection_export_path(library_id, c) for c in collections]
+    if library or tags:
+        paths.append(library_export_path(library_id))
+
+    exports = executor.map(lambda path: get_json(pool.get(), path), paths)
+    citekeys = executor.map(lambda tag: search_tag(pool.get(), tag), tags)
+    exports = list(exports)
+    tagged = set().union(*citekeys)
+
+    selected = {}
+    for items in exports[: len(collections)]:
+        for item in items:
+            selected.setdefault(item["id"], item)
+    if library or tags:
+        for item in exports[-1]:
+            if library or item["id"] in tagged:
+                selected.setdefault(item["id"], item)
+    return list(selected.values())
+
+
+def fetch_notes(pool, executor, items):
+    """Yield (batch, notes) in order, while later batches are still being
+    fetched by the executor."""
+
+    def fetch(batch):
+        ids = [item["id"] for item in batch]
+        return batch, json_rpc(pool.get(), "item.notes", [ids])
+
+    yield from executor.map(fetch, itertools.batched(items, NOTES_BATCH_SIZE))
+
+
+def get_local_api(conn, path):
+    conn.request("GET", path, headers={"Zotero-API-Version": "3"})
+    resp = conn.getresponse()
+    body = resp.read().decode("utf-8")
+    if resp.status != 200:
+        raise RuntimeError(f"GET {path} failed: {resp.status} {body}")
+    return json.loads(body), int(resp.getheader("Last-Modified-Version", "0"))
+
+
+def changed_item_keys(pool, executor, since):
+    """Return the keys of top-level items whose data, notes or annotations
+    changed after library version `since`, and the current library version.
+
+    Editing a note or an annotation does not touch the parent item, so changed
+    child items are resolved to their top-level items through parentItem.
+    """
+    versions, library_version = get_local_api(
+        pool.get(), f"/api/users/0/items?since={since}&format=versions"
+    )
+
+    def fetch(keys):
+        path = f"/api/users/0/items?itemKey={','.join(keys)}&limit={LOCAL_API_BATCH_SIZE}"
+        return get_local_api(pool.get(), path)[0]
+
+    changed = set()
+    resolved = set()
+    pending = set(versions)
+    while pending:
+        resolved |= pending
+        parents = set()
+        batches = itertools.batched(sorted(pending), LOCAL_API_BATCH_SIZE)
+        for entries in executor.map(fetch, batches):
+            for entry in entries:
+                parent = entry["data"].get("parentItem")
+                if parent:
+                    parents.add(parent)
+                else:
+                    changed.add(entry["key"])
+        pending = parents - resolved
+    return changed, library_version
+
+
+def select_changed_items(pool, executor, items, state):
+    """Drop items that have not changed since the last sync, before their
+    notes are fetched. Returns the items and the library version to record."""
+    try:
+        if "version" not in state:
+            _, version = get_local_api(
+                pool.get(), "/api/users/0/items?limit=1&format=versions"
+            )
+            return items, version
+        changed, version = changed_item_keys(pool, executor, state["version"])
+    except (OSError, RuntimeError) as err:
+        print(f"Zotero local API unavailable, syncing all items: {err}", file=sys.stderr)
+        return items, state.get("version")
+
+    seen = set(state.get("items", []))
+    return [
+        item
+        for item in items
+        if item["item-key"] in changed or item["item-key"] not in seen
+    ], version
+
+
+def highlight_key(entry):
+    query = urllib.parse.urlsplit(entry.get("highlight_url", "")).query
+    annotation_keys = urllib.parse.parse_qs(query).get("annotation")
+    if annotation_keys:
+        return annotation_keys[0]
+    digest = hashlib.sha1(entry["text"].encode("utf-8")).hexdigest()[:8]
+    return f"{entry['source_url']}#{digest}"
+
+
+def highlight_digest(entry):
+    raw = json.dumps(entry, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def filter_synced_highlights(highlights, state):
+    """Keep only new or edited highlights, and record them in the state."""
+    annotations = state.setdefault("annotations", {})
+    result = []
+    for entry in highlights:
+        key = highlight_key(entry)
+        digest = highlight_digest(entry)
+        if annotations.get(key) != digest:
+            annotations[key] = digest
+            result.append(entry)
+    return result
+
+
+def number_item_highlights(highlights):
+    """Auto-number the highlights of each item on its own, so the numbers do
+    not depend on which other items changed since the last sync."""
+    items = {}
+    for entry in highlights:
+        items.setdefault(entry["source_url"], []).append(entry)
+    for entries in items.values():
+        utils.auto_number_highlights(entries)
 
 
 def format_author(authors):
@@ -48,7 +392,7 @@ def format_author(authors):
     )
 
 
-def collect_highlights(item, highlights):
+def collect_highlights(item, notes, highlights):
     article = {
         "title": titlecase(item["title"]),
         "author": format_author(item["author"]),
@@ -57,17 +401,6 @@ def collect_highlights(item, highlights):
         "category": "books" if item["type"] == "book" else "articles",
     }
 
-    req = Request(
-        "http://localhost:23119/better-bibtex/json-rpc",
-        data=json.dumps(
-            {"jsonrpc": "2.0", "method": "item.notes", "params": [[item["id"]]]}
-        ).encode("utf-8"),
-        headers={"Content-Type": "application/json", "Accept": "application/json"},
-        method="POST",
-    )
-    with urlopen(req) as resp:
-        notes = json.loads(resp.read().decode("utf-8"))["result"][item["id"]]
-
     for note in notes:
         soup = BeautifulSoup(replace_br(note), "html.parser")
         if soup.div is None:
@@ -77,13 +410,13 @@ def collect_highlights(item, highlights):
             continue
         for p in soup.find_all("p"):
             highlight_tags = []
-            for tag in p.select("span.highlight"):
+            for tag in p.find_all("span", class_="highlight"):
                 highlight_tags.append(tag.extract())
-            for tag in p.select("span.underline"):
+            for tag in p.find_all("span", class_="underline"):
                 highlight_tags.append(tag.extract())
-            for tag in p.select("img.data-annotation"):
+            for tag in p.find_all("img", class_="data-annotation"):
                 highlight_tags.append(tag.extract())
-            for tag in p.select("span.citation"):
+            for tag in p.find_all("span", class_="citation"):
                 tag.decompose()
             annotation = bs2md(p).strip()
             highlights.append(
@@ -92,7 +425,7 @@ def collect_highlights(item, highlights):
 
 
 def get_highlight_text(highlight):
-    text = bs2md(BeautifulSoup(replace_br(highlight), "html.parser")).strip()
+    text = bs2md(highlight, br="\n").strip()
     if text.startswith("“") and text.endswith("”"):
         return text[1:-1]
     if text.startswith("\u201c") and text.endswith("\u201d"):
@@ -104,38 +437,58 @@ def replace_br(html):
     return str(html).replace("<br/>", "\n").replace("<br>", "\n")
 
 
-def bs2md(bs):
+MARKS = {
+    "b": "**",
+    "strong": "**",
+    "i": "*",
+    "em": "*",
+    "emph": "*",
+    "code": "`",
+}
+
+
+def bs2md(bs, br=""):
+    """Render the node as Markdown in one iterative walk.
+
+    `<br>` and `<br/>` in the raw note are already replaced by replace_br, the
+    remaining `<br />` tags render as `br`. Highlights pass "\n" because they
+    used to be re-serialized and went through replace_br a second time.
+    """
     from bs4 import NavigableString
 
     if bs is None:
         return ""
 
-    # If it's a text node (NavigableString), return the text
-    if isinstance(bs, NavigableString):
-        return str(bs)
-
-    # If it's a Tag, process it
-    if hasattr(bs, "name"):
-        inner = "".join(bs2md(child) for child in bs.children)
-        if bs.name in ["b", "strong"]:
-            return f"**{inner}**"
-        elif bs.name in ["i", "em", "emph"]:
-            return f"*{inner}*"
-        elif bs.name == "code":
-            return f"`{inner}`"
-        elif bs.name == "img":
-            attachment_key = bs.get("data-attachment-key")
+    parts = []
+    stack = [bs]
+    while stack:
+        node = stack.pop()
+        # Closing marks are pushed as plain strings
+        if type(node) is str:
+            parts.append(node)
+        elif isinstance(node, NavigableString):
+            parts.append(str(node))
+        elif node.name in MARKS:
+            mark = MARKS[node.name]
+            parts.append(mark)
+            stack.append(mark)
+            stack.extend(reversed(node.contents))
+        elif node.name == "br":
+            parts.append(br)
+        elif node.name == "img":
+            attachment_key = node.get("data-attachment-key")
             image_path = get_image_path(attachment_key)
             if image_path is None:
                 raise RuntimeError(f"Image not found: {attachment_key}")
 
-            copy_image(attachment_key)
-            return f"![{attachment_key}]({UPLOADS_SITE}/{UPLOADS_DIR.as_posix()}/{attachment_key}/{image_path.name})"
+            PENDING_IMAGES.add(attachment_key)
+            parts.append(
+                f"![{attachment_key}]({UPLOADS_SITE}/{UPLOADS_DIR.as_posix()}/{attachment_key}/{upload_name(image_path)})"
+            )
         else:
-            return inner
+            stack.extend(reversed(node.contents))
 
-    # Fallback for other types
-    return bs.get_text()
+    return "".join(parts)
 
 
 def format_highlight(entry, highlight_tags, annotation):
@@ -143,14 +496,19 @@ def format_highlight(entry, highlight_tags, annotation):
         entry["text"] = annotation
         return entry
 
-    entry["text"] = "…".join(get_highlight_text(h) for h in highlight_tags)
+    text = "…".join(get_highlight_text(h) for h in highlight_tags)
+    data = json.loads(urllib.parse.unquote(highlight_tags[0]["data-annotation"]))
+    return format_annotation(entry, text, annotation, data)
+
+
+def format_annotation(entry, text, annotation, data):
+    entry["text"] = text
 
     if annotation != "":
         if annotation.startswith(".") and "\n" not in annotation:
             entry["note"] = annotation + "\n"
         else:
             entry["note"] = annotation
-    data = json.loads(urllib.parse.unquote(highlight_tags[0]["data-annotation"]))
     is_epub = data["position"].get("type", "") == "FragmentSelector"
     item_key = data["attachmentURI"].split("/")[-1]
     if not is_epub:
@@ -171,6 +529,166 @@ def format_highlight(entry, highlight_tags, annotation):
     return entry
 
 
+# itemAnnotations.type
+ANNOTATION_HIGHLIGHT = 1
+ANNOTATION_NOTE = 2
+ANNOTATION_UNDERLINE = 5
+ANNOTATION_TEXT = 6
+
+SQLITE_ITEMS = """
+SELECT i.itemID, i.key, t.typeName, v.value
+FROM items i
+JOIN itemTypes t ON t.itemTypeID = i.itemTypeID
+JOIN itemData d ON d.itemID = i.itemID
+JOIN fields f ON f.fieldID = d.fieldID AND f.fieldName = 'title'
+JOIN itemDataValues v ON v.valueID = d.valueID
+WHERE i.libraryID = ? AND i.itemID NOT IN (SELECT itemID FROM deletedItems)
+"""
+
+SQLITE_AUTHORS = """
+SELECT ic.itemID, c.firstName, c.lastName, c.fieldMode
+FROM itemCreators ic
+JOIN creators c ON c.creatorID = ic.creatorID
+JOIN creatorTypes ct ON ct.creatorTypeID = ic.creatorTypeID
+WHERE ct.creatorType = 'author'
+ORDER BY ic.itemID, ic.orderIndex
+"""
+
+SQLITE_ANNOTATIONS = """
+SELECT att.parentItemID, attItem.key, annItem.key,
+       ann.type, ann.text, ann.comment, ann.pageLabel, ann.position
+FROM itemAnnotations ann
+JOIN items annItem ON annItem.itemID = ann.itemID
+JOIN itemAttachments att ON att.itemID = ann.parentItemID
+JOIN items attItem ON attItem.itemID = att.itemID
+WHERE annItem.libraryID = ?
+  AND ann.itemID NOT IN (SELECT itemID FROM deletedItems)
+  AND att.itemID NOT IN (SELECT itemID FROM deletedItems)
+ORDER BY att.parentItemID, att.itemID, ann.sortIndex
+"""
+
+
+def open_zotero_db(path, tmp_dir):
+    """Open a read-only copy of zotero.sqlite, which Zotero locks while it
+    is running."""
+    copy = Path(tmp_dir) / "zotero.sqlite"
+    shutil.copy2(path, copy)
+    wal = Path(f"{path}-wal")
+    if wal.exists():
+        shutil.copy2(wal, Path(f"{copy}-wal"))
+    return sqlite3.connect(f"{copy.as_uri()}?mode=ro", uri=True)
+
+
+def select_sqlite_items(db, library_id, collections, tags):
+    """Return the selected item IDs, or None for the whole library."""
+    if not collections and not tags:
+        return None
+
+    selected = set()
+    for path in collections:
+        collection_id = None
+        for name in path.strip("/").split("/"):
+            row = db.execute(
+                "SELECT collectionID FROM collections"
+                " WHERE libraryID = ? AND collectionName = ? AND parentCollectionID IS ?",
+                (library_id, name, collection_id),
+            ).fetchone()
+            if row is None:
+                raise RuntimeError(f"Collection not found: {path}")
+            collection_id = row[0]
+        selected.update(
+            row[0]
+            for row in db.execute(
+                "SELECT itemID FROM collectionItems WHERE collectionID = ?",
+                (collection_id,),
+            )
+        )
+    if tags:
+        placeholders = ", ".join("?" * len(tags))
+        selected.update(
+            row[0]
+            for row in db.execute(
+                "SELECT itemID FROM itemTags JOIN tags ON tags.tagID = itemTags.tagID"
+                f" WHERE tags.name IN ({placeholders})",
+                tags,
+            )
+        )
+    return selected
+
+
+def collect_sqlite_highlights(db, library_id, selected):
+    """Read annotations with a few bulk queries and format them like the
+    notes from Better BibTeX. Image and ink annotations are skipped."""
+    items = {}
+    for item_id, key, type_name, title in db.execute(SQLITE_ITEMS, (library_id,)):
+        if selected is None or item_id in selected:
+            items[item_id] = {
+                "title": title,
+                "author": [],
+                "type": type_name,
+                "item-key": key,
+            }
+    for item_id, first_name, last_name, field_mode in db.execute(SQLITE_AUTHORS):
+        if item_id in items:
+            items[item_id]["author"].append(
+                {"literal": last_name}
+                if field_mode == 1
+                else {"given": first_name, "family": last_name}
+            )
+
+    highlights = []
+    article = None
+    last_item_id = None
+    for (
+        item_id,
+        attachment_key,
+        annotation_key,
+        annotation_type,
+        text,
+        comment,
+        page_label,
+        position,
+    ) in db.execute(SQLITE_ANNOTATIONS, (library_id,)):
+        if item_id not in items:
+            continue
+        if item_id != last_item_id:
+            last_item_id = item_id
+            item = items[item_id]
+            article = {
+                "title": titlecase(item["title"]),
+                "author": format_author(item["author"]),
+                "source_url": f"zotero://select/library/items/{item['item-key']}",
+                "source_type": "Zotero",
+                "category": "books" if item["type"] == "book" else "articles",
+            }
+
+        annotation = (comment or "").strip()
+        if annotation_type in [ANNOTATION_NOTE, ANNOTATION_TEXT]:
+            highlights.append(format_highlight(article.copy(), [], annotation))
+        elif annotation_type in [ANNOTATION_HIGHLIGHT, ANNOTATION_UNDERLINE]:
+            data = {
+                "position": json.loads(position),
+                "pageLabel": page_label,
+                "annotationKey": annotation_key,
+                "attachmentURI": f"zotero://select/library/items/{attachment_key}",
+            }
+            highlights.append(
+                format_annotation(article.copy(), (text or "").strip(), annotation, data)
+            )
+
+    return highlights
+
+
+def read_sqlite_highlights(path, library_id, collections, tags):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = open_zotero_db(path, tmp_dir)
+        try:
+            selected = select_sqlite_items(db, library_id, collections, tags)
+            return collect_sqlite_highlights(db, library_id, selected)
+        finally:
+            db.close()
+
+
 def is_title(entry):
     return (
         "note" in entry
@@ -223,23 +741,114 @@ def squash_concatenating_highlights(highlights):
         yield concatenate_highlights(pending_spans)
 
 
-def main(dry_run=False):
-    items = get_items()
-    highlights = []
-    for item in items:
-        collect_highlights(item, highlights)
+def main():
+    global IMAGE_FORMAT, IMAGE_MAX_WIDTH
+
+    parser = argparse.ArgumentParser(description="Export Zotero annotations to Readwise.")
+    parser.add_argument(
+        "-n", "--dry-run", action="store_true", help="Print highlights instead of uploading"
+    )
+    parser.add_argument(
+        "--library", action="store_true", help="Export every item in the library"
+    )
+    parser.add_argument(
+        "--collection",
+        action="append",
+        default=[],
+        help="Export items in the collection path, e.g. Reading/2024",
+    )
+    parser.add_argument(
+        "--tag", action="append", default=[], help="Export items with the tag"
+    )
+    parser.add_argument("--library-id", type=int, default=1, help="Zotero library ID")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=4, help="Concurrent Better BibTeX requests"
+    )
+    parser.add_argument(
+        "--sqlite",
+        nargs="?",
+        const=ZOTERO_SQLITE,
+        type=Path,
+        help="Read annotations from a copy of zotero.sqlite instead of Better BibTeX",
+    )
+    parser.add_argument(
+        "--sync",
+        action="store_true",
+        help="Only upload annotations added or edited since the last sync",
+    )
+    parser.add_argument(
+        "--image-format",
+        choices=sorted(TRANSCODE_EXTENSIONS),
+        help="Transcode annotation images to this format (requires Pillow)",
+    )
+    parser.add_argument(
+        "--image-max-width",
+        type=int,
+        default=IMAGE_MAX_WIDTH,
+        help="Maximum width of transcoded images",
+    )
+    args = parser.parse_args()
+
+    IMAGE_FORMAT = args.image_format
+    IMAGE_MAX_WIDTH = args.image_max_width
+
+    state = utils.load_json(SYNC_STATE, {}) if args.sync else None
+    version = None
+    if args.sqlite is not None:
+        items = []
+        highlights = read_sqlite_highlights(
+            args.sqlite, args.library_id, args.collection, args.tag
+        )
+    else:
+        highlights = []
+        pool = ConnectionPool()
+        try:
+            with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+                if args.library or args.collection or args.tag:
+                    items = select_items(
+                        pool,
+                        executor,
+                        args.library,
+                        args.collection,
+                        args.tag,
+                        args.library_id,
+                    )
+                else:
+                    items = get_items(pool.get())
+
+                if state is not None:
+                    items, version = select_changed_items(pool, executor, items, state)
+
+                for batch, notes in fetch_notes(pool, executor, items):
+                    for item in batch:
+                        collect_highlights(item, notes.get(item["id"], []), highlights)
+        finally:
+            pool.close()
+
+    if PENDING_IMAGES:
+        copy_images(sorted(PENDING_IMAGES), args.jobs)
 
     highlights = list(squash_concatenating_highlights(highlights))
+    if state is not None:
+        # Number before filtering, so unchanged highlights keep their order
+        number_item_highlights(highlights)
+        highlights = filter_synced_highlights(highlights, state)
 
-    if dry_run:
+    if args.dry_run:
         print(json.dumps(highlights, indent=2))
         return
 
-    utils.create_highlights(highlights)
+    if highlights:
+        utils.create_highlights(highlights)
 
+    if state is not None:
+        if version is not None:
+            state["version"] = version
+        state["items"] = sorted(
+            set(state.get("items", [])) | {item["item-key"] for item in items}
+        )
+        utils.save_json_atomic(SYNC_STATE, state, indent=2, sort_keys=True)
 
-if __name__ == "__main__":
-    import sys
 
-    dry_run = sys.argv[1] == "-n" if len(sys.argv) > 1 else False
-    main(dry_run)
+if __name__ == "__main__":
+    main()
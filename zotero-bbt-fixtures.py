@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+
+# ruff: noqa: E501
+
+"""Record, replay and generate Better BibTeX responses, so the Zotero importer
+can be tested and benchmarked without Zotero.
+
+```
+# record while using the importer against the real Zotero
+./zotero-bbt-fixtures.py record fixtures &
+BBT_PORT=23120 ./zotero-annotations-to-readwise.py -n
+
+# or generate 500 items with 200 annotations each
+./zotero-bbt-fixtures.py generate --items 500 --annotations 200 fixtures
+
+# replay with 20ms latency per request
+./zotero-bbt-fixtures.py serve --latency 0.02 fixtures &
+time BBT_PORT=23120 ./zotero-annotations-to-readwise.py -n --library > /dev/null
+```
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+import urllib.parse
+from http.client import HTTPConnection
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import utils
+
+UPSTREAM_HOST = "127.0.0.1"
+UPSTREAM_PORT = 23119
+PORT = 23120
+JSON_RPC_PATH = "/better-bibtex/json-rpc"
+CAYW_PATH = "/better-bibtex/cayw?&format=translate&translator=csljson"
+WORDS = "the of and to in a is that for it as was with be by on not he this are or his from at which but have".split()
+
+
+def request_key(method, path, body):
+    raw = f"{method} {path}\n".encode("utf-8") + body
+    return hashlib.sha1(raw).hexdigest()
+
+
+class Fixtures:
+    """Responses stored in `dir`.
+
+    `requests/<sha1>.json` holds a response keyed by method, path and body.
+    `notes/<citekey>.json` holds the item.notes result of a single item, so
+    notes can be replayed with any batching.
+    """
+
+    def __init__(self, dir):
+        self.dir = Path(dir)
+
+    def request_path(self, method, path, body):
+        return self.dir / "requests" / f"{request_key(method, path, body)}.json"
+
+    def notes_path(self, citekey):
+        quoted = urllib.parse.quote(citekey, safe="")
+        return self.dir / "notes" / f"{quoted}.json"
+
+    def save_response(self, method, path, body, status, content_type, response):
+        utils.save_json_atomic(
+            self.request_path(method, path, body),
+            {
+                "method": method,
+                "path": path,
+                "body": body.decode("utf-8"),
+                "status": status,
+                "content_type": content_type,
+                "response": response.decode("utf-8"),
+            },
+            indent=2,
+            ensure_ascii=False,
+        )
+
+    def load_response(self, method, path, body):
+        return utils.load_json(self.request_path(method, path, body))
+
+    def save_notes(self, citekey, notes):
+        utils.save_json_atomic(
+            self.notes_path(citekey), notes, indent=2, ensure_ascii=False
+        )
+
+    def load_notes(self, citekey):
+        return utils.load_json(self.notes_path(citekey), [])
+
+
+def parse_notes_request(path, body):
+    """Return the citekeys of an item.notes call, or None for other calls."""
+    if path != JSON_RPC_PATH:
+        return None
+    try:
+        request = json.loads(body)
+    except ValueError:
+        return None
+    if request.get("method") != "item.notes":
+        return None
+    return request["params"][0]
+
+
+def make_handler(fixtures, upstream=None, latency=0.0):
+    local = threading.local()
+
+    def forward(method, path, body, headers):
+        conn = getattr(local, "conn", None)
+        if conn is None:
+            conn = local.conn = HTTPConnection(*upstream)
+        conn.request(method, path, body=body or None, headers=headers)
+        resp = conn.getresponse()
+        return resp.status, resp.getheader("Content-Type", "application/json"), resp.read()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def reply(self, status, content_type, body):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def handle_request(self):
+            length = int(self.headers.get("Content-Length", 0))
+            body = self.rfile.read(length) if length > 0 else b""
+            citekeys = parse_notes_request(self.path, body)
+
+            if upstream is not None:
+                headers = {
+                    key: value
+                    for key, value in self.headers.items()
+                    if key.lower() not in ["host", "connection"]
+                }
+                status, content_type, response = forward(
+                    self.command, self.path, body, headers
+                )
+                if citekeys is not None and status == 200:
+                    result = json.loads(response)["result"]
+                    for citekey in citekeys:
+                        fixtures.save_notes(citekey, result.get(citekey, []))
+                else:
+                    fixtures.save_response(
+                        self.command, self.path, body, status, content_type, response
+                    )
+                return self.reply(status, content_type, response)
+
+            time.sleep(latency)
+            if citekeys is not None:
+                result = {citekey: fixtures.load_notes(citekey) for citekey in citekeys}
+                response = json.dumps({"jsonrpc": "2.0", "result": result})
+                return self.reply(200, "application/json", response.encode("utf-8"))
+
+            saved = fixtures.load_response(self.command, self.path, body)
+            if saved is None:
+                return self.reply(404, "text/plain", f"No fixture for {self.path}".encode("utf-8"))
+            self.reply(
+                saved["status"], saved["content_type"], saved["response"].encode("utf-8")
+            )
+
+        do_GET = handle_request
+        do_POST = handle_request
+
+    return Handler
+
+
+def random_text(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+
+def generate_note(rng, item_index, item_key, attachment_key, citekey, annotations):
+    paragraphs = []
+    for index in range(annotations):
+        # Unique across items, as Zotero keys are
+        annotation_key = f"{item_index:04X}{index:04X}"
+        page = index // 10 + 1
+        data = {
+            "attachmentURI": f"http://zotero.org/users/1/items/{attachment_key}",
+            "annotationKey": annotation_key,
+            "color": "#ffd400",
+            "pageLabel": str(page),
+            "position": {"pageIndex": page + 8, "rects": [[72, 497.375, 308.624, 520.218]]},
+            "citationItem": {"uris": [f"http://zotero.org/users/1/items/{item_key}"], "locator": str(page)},
+        }
+        citation = {"citationItems": [{"uris": data["citationItem"]["uris"], "locator": str(page)}], "properties": {}}
+        if index % 25 == 0:
+            comment = ".h1"
+        elif index % 7 == 0:
+            comment = random_text(rng, 8)
+        else:
+            comment = ""
+        paragraphs.append(
+            f'<p><span class="highlight" data-annotation="{urllib.parse.quote(json.dumps(data))}">'
+            f"“{random_text(rng, rng.randint(5, 40))}”</span> "
+            f'<span class="citation" data-citation="{urllib.parse.quote(json.dumps(citation))}">'
+            f'(<span class="citation-item">{citekey}, p. {page}</span>)</span> {comment}</p>'
+        )
+    return (
+        '<div data-citation-items="" data-schema-version="8">'
+        "<h1>Annotations<br>(1/1/2024, 12:00:00 AM)</h1>\n"
+        + "\n".join(paragraphs)
+        + "\n</div>"
+    )
+
+
+def generate(fixtures, items, annotations, library_id, seed):
+    rng = random.Random(seed)
+    csl_items = []
+    for index in range(items):
+        item_key = f"I{index:07d}"
+        citekey = f"author{index}title"
+        csl_items.append(
+            {
+                "id": citekey,
+                "type": "book" if index % 2 == 0 else "article-journal",
+                "title": random_text(rng, 4)[:-1],
+                "author": [{"family": f"Author{index}", "given": "Synthetic"}],
+                "item-key": item_key,
+            }
+        )
+        note = generate_note(
+            rng, index, item_key, f"A{index:07d}", citekey, annotations
+        )
+        fixtures.save_notes(citekey, [note])
+
+    response = json.dumps(csl_items).encode("utf-8")
+    library_path = f"/better-bibtex/export/library?/{library_id}/library.csljson"
+    for path in [CAYW_PATH, library_path]:
+        fixtures.save_response("GET", path, b"", 200, "application/json", response)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    record = subparsers.add_parser("record", help="Proxy to Better BibTeX and save responses")
+    record.add_argument("dir", help="Fixture directory")
+    record.add_argument("--port", type=int, default=PORT)
+    record.add_argument("--upstream-port", type=int, default=UPSTREAM_PORT)
+
+    serve = subparsers.add_parser("serve", help="Replay saved responses")
+    serve.add_argument("dir", help="Fixture directory")
+    serve.add_argument("--port", type=int, default=PORT)
+    serve.add_argument("--latency", type=float, default=0.0, help="Seconds to wait per request")
+
+    gen = subparsers.add_parser("generate", help="Generate synthetic fixtures")
+    gen.add_argument("dir", help="Fixture directory")
+    gen.add_argument("--items", type=int, default=100)
+    gen.add_argument("--annotations", type=int, default=50, help="Annotations per item")
+    gen.add_argument("--library-id", type=int, default=1)
+    gen.add_argument("--seed", type=int, default=0)
+
+    args = parser.parse_args()
+    fixtures = Fixtures(args.dir)
+
+    if args.command == "generate":
+        generate(fixtures, args.items, args.annotations, args.library_id, args.seed)
+        return
+
+    if args.command == "record":
+        handler = make_handler(fixtures, upstream=(UPSTREAM_HOST, args.upstream_port))
+    else:
+        handler = make_handler(fixtures, latency=args.latency)
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), handler)
+    print(f"Listening on 127.0.0.1:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()